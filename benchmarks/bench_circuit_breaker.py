@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the circuit breakers locally without any external services.
+
+Run it in the root directory of the repository:
+
+    $ PYTHONPATH=. python benchmarks/bench_circuit_breaker.py --threads 1,8,64
+
+It calls a trivial function through one shared CircuitBreaker in the closed
+state by the threads, and reports the calls per second with the closed-state
+fast path, without it (every call takes the lock twice), and of
+WindowedCircuitBreaker for reference.
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+
+from threading import Thread
+
+from xutils.circuit_breaker import CircuitBreaker, WindowedCircuitBreaker
+
+
+class _LockedCircuitBreaker(CircuitBreaker):
+    FAST_PATH = False
+
+
+def _func():
+    return 1
+
+
+def run_calls(breaker, threads, loops):
+    """Call through the breaker by the threads, and return the calls/sec."""
+
+    def _call():
+        call = breaker.call
+        for _ in range(loops):
+            call(_func)
+
+    workers = [Thread(target=_call) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * loops / (time.time() - start)
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xutils.circuit_breaker.")
+    parser.add_argument("--threads", type=_int_list, default=[1, 8, 64])
+    parser.add_argument("--loops", type=int, default=20000,
+                        help="the number of the calls by each thread")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    breakers = [
+        ("fast path", CircuitBreaker),
+        ("locked", _LockedCircuitBreaker),
+        ("windowed", WindowedCircuitBreaker),
+    ]
+
+    print("%-8s" % "threads" + "".join("%-20s" % (name + "(calls/s)")
+                                       for name, _ in breakers))
+    for threads in args.threads:
+        line = "%-8d" % threads
+        for _, cls in breakers:
+            best = max(run_calls(cls(), threads, args.loops)
+                       for _ in range(args.repeat))
+            line += "%-20.0f" % best
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
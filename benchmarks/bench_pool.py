@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the resource pools locally without any external services.
+
+Run it in the root directory of the repository:
+
+    $ PYTHONPATH=. python benchmarks/bench_pool.py load --threads 1,8,64 \
+        --capacity 16 --hold exp:0.001 --idle-timeout 1 --duration 3
+    $ PYTHONPATH=. python benchmarks/bench_pool.py scaling
+    $ PYTHONPATH=. python benchmarks/bench_pool.py session
+
+"load" drives the pool with the threads, each of which borrows an object,
+holds it for a time drawn from the hold-time distribution, then returns it,
+and reports the throughput and the percentiles of the borrow latency.
+The objects are fake, and their creation takes --create-time seconds.
+
+The hold-time distribution is one of:
+
+    const:SECONDS           always SECONDS
+    uniform:MIN:MAX         uniformly distributed between MIN and MAX
+    exp:MEAN                exponentially distributed with MEAN
+"""
+
+from __future__ import print_function
+
+import time
+import random
+import timeit
+import argparse
+
+from threading import Thread
+
+from xutils.pool import (AUTOWRAP_FAST, STRATEGY_FIFO, STRATEGY_LIFO,
+                         ResourcePool, ShardedResourcePool)
+
+_now = getattr(time, "perf_counter", time.time)
+
+
+class _Object(object):
+    value = 1
+
+    def ping(self):
+        return self.value
+
+    def close(self):
+        pass
+
+
+class _SlowObject(_Object):
+    create_time = 0
+
+    def __init__(self):
+        if self.create_time:
+            time.sleep(self.create_time)
+
+
+def parse_distribution(spec):
+    """Parse the hold-time distribution, and return a function which takes
+    a random.Random and returns the hold time."""
+
+    name, _, args = spec.partition(":")
+    args = [float(arg) for arg in args.split(":")] if args else []
+    if name == "const" and len(args) == 1:
+        return lambda rand: args[0]
+    elif name == "uniform" and len(args) == 2:
+        return lambda rand: rand.uniform(args[0], args[1])
+    elif name == "exp" and len(args) == 1:
+        return lambda rand: rand.expovariate(1.0 / args[0]) if args[0] else 0
+    raise ValueError("invalid distribution '%s'" % spec)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of the sorted values."""
+
+    if not values:
+        return 0.0
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def new_pool(kind, capacity, idle_timeout, shards):
+    kwargs = {"capacity": capacity, "idle_timeout": idle_timeout}
+    if kind == "fifo":
+        return ResourcePool(_SlowObject, strategy=STRATEGY_FIFO, **kwargs)
+    elif kind == "lifo":
+        return ResourcePool(_SlowObject, strategy=STRATEGY_LIFO, **kwargs)
+    elif kind == "sharded":
+        return ShardedResourcePool(_SlowObject, shards=shards, **kwargs)
+    raise ValueError("unknown pool '%s'" % kind)
+
+
+def run_load(pool, threads, duration, hold, seed, timeout=None):
+    """Drive the pool for duration seconds, and return the result as a dict."""
+
+    results = []
+    deadline = time.time() + duration
+
+    def _work(index):
+        rand = random.Random(seed + index)
+        latencies, timeouts = [], 0
+        while time.time() < deadline:
+            start = _now()
+            try:
+                obj = pool.get(timeout=timeout)
+            except Exception:
+                timeouts += 1
+                continue
+            latencies.append(_now() - start)
+
+            hold_time = hold(rand)
+            if hold_time > 0:
+                time.sleep(hold_time)
+            pool.put(obj)
+        results.append((latencies, timeouts))
+
+    workers = [Thread(target=_work, args=(i,)) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(v for result in results for v in result[0])
+    stats = pool.stats()
+    return {
+        "threads": threads,
+        "borrows": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+        "timeouts": sum(result[1] for result in results),
+        "created": stats["created"],
+        "size": stats["size"],
+    }
+
+
+def bench_load(args):
+    _SlowObject.create_time = args.create_time
+    hold = parse_distribution(args.hold)
+
+    print("pool=%s capacity=%d hold=%s idle_timeout=%s create_time=%s seed=%d"
+          % (args.pool, args.capacity, args.hold, args.idle_timeout,
+             args.create_time, args.seed))
+    print("%-8s %-12s %-12s %-12s %-12s %-10s %-10s %-6s" % (
+        "threads", "borrows/s", "p50(us)", "p99(us)", "max(us)", "timeouts",
+        "created", "size"))
+
+    for threads in args.threads:
+        pool = new_pool(args.pool, args.capacity, args.idle_timeout, args.shards)
+        try:
+            r = run_load(pool, threads, args.duration, hold, args.seed,
+                         args.timeout)
+        finally:
+            pool.close()
+
+        print("%-8d %-12.0f %-12.1f %-12.1f %-12.1f %-10d %-10d %-6d" % (
+            r["threads"], r["throughput"], r["p50"] * 1e6, r["p99"] * 1e6,
+            r["max"] * 1e6, r["timeouts"], r["created"], r["size"]))
+
+
+def run_scaling(pool, threads, loops):
+    def _borrow():
+        for _ in range(loops):
+            pool.put(pool.get())
+
+    workers = [Thread(target=_borrow) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * loops / (time.time() - start)
+
+
+def bench_scaling(args):
+    def best_of(new_pool):
+        return max(run_scaling(new_pool(), threads, args.loops)
+                   for _ in range(args.repeat))
+
+    print("%-8s %-28s %-28s" % ("threads", "ResourcePool(ops/s)",
+                                 "ShardedResourcePool(ops/s)"))
+    for threads in args.threads:
+        pool = best_of(lambda: ResourcePool(_Object, capacity=args.capacity))
+        sharded = best_of(lambda: ShardedResourcePool(
+            _Object, shards=args.shards, capacity=args.capacity))
+        print("%-8d %-28.0f %-28.0f" % (threads, pool, sharded))
+
+
+def bench_session(args):
+    objs = [
+        ("raw object", _Object()),
+        ("session", ResourcePool(_Object, autowrap=True).get()),
+        ("fast session", ResourcePool(_Object, autowrap=AUTOWRAP_FAST).get()),
+    ]
+
+    print("%-16s %-20s %-20s" % ("access by", "method call(ns)", "attribute(ns)"))
+    for name, obj in objs:
+        call = min(timeit.repeat("obj.ping()", globals={"obj": obj},
+                                 number=args.number, repeat=args.repeat))
+        attr = min(timeit.repeat("obj.value", globals={"obj": obj},
+                                 number=args.number, repeat=args.repeat))
+        print("%-16s %-20.1f %-20.1f" % (name, call * 1e9 / args.number,
+                                         attr * 1e9 / args.number))
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xutils.pool.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    load = subparsers.add_parser("load", help="borrow under a workload")
+    load.add_argument("--pool", default="fifo", choices=("fifo", "lifo", "sharded"))
+    load.add_argument("--threads", type=_int_list, default=[1, 8, 64])
+    load.add_argument("--capacity", type=int, default=16)
+    load.add_argument("--shards", type=int, default=8)
+    load.add_argument("--hold", default="exp:0.001",
+                      help="the hold-time distribution, such as const:0.001")
+    load.add_argument("--idle-timeout", type=float, default=None)
+    load.add_argument("--create-time", type=float, default=0.001)
+    load.add_argument("--timeout", type=float, default=None,
+                      help="the timeout of borrowing an object")
+    load.add_argument("--duration", type=float, default=3)
+    load.add_argument("--seed", type=int, default=0)
+    load.set_defaults(func=bench_load)
+
+    scaling = subparsers.add_parser("scaling", help="get/put as threads scale")
+    scaling.add_argument("--threads", type=_int_list,
+                         default=[1, 2, 4, 8, 16, 32, 64, 128])
+    scaling.add_argument("--capacity", type=int, default=64)
+    scaling.add_argument("--shards", type=int, default=16)
+    scaling.add_argument("--loops", type=int, default=20000)
+    scaling.add_argument("--repeat", type=int, default=3)
+    scaling.set_defaults(func=bench_scaling)
+
+    session = subparsers.add_parser("session", help="access by the session")
+    session.add_argument("--number", type=int, default=1000000)
+    session.add_argument("--repeat", type=int, default=3)
+    session.set_defaults(func=bench_session)
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the rate limiters locally without any external services.
+
+Run it in the root directory of the repository:
+
+    $ PYTHONPATH=. python benchmarks/bench_rate.py keyed --keys 1000000
+    $ PYTHONPATH=. python benchmarks/bench_rate.py deviation --rate 100
+    $ PYTHONPATH=. python benchmarks/bench_rate.py check
+
+"keyed" fills KeyedRate with the distinct keys, reports the memory of the
+per-key state measured by tracemalloc, excluding the keys themselves, the
+checks per second of the random keys, and the latency of checking the new
+keys when it's full. With a higher --rate, the keys become idle during the
+fill and are swept.
+
+"deviation" drives each algorithm by a greedy client, which acquires as many
+tokens as possible every --step seconds by a virtual clock, so it runs fast
+and is deterministic. It reports how far the output deviates from the rate
+over the whole run and in the strictest windows, which is what an upstream
+with a per-second quota sees. "tick" is the reference of the quantized refill,
+which added rate // hz tokens every tick like the old Rate.
+
+"check" measures the same for some rates and bursts, and fails unless each
+algorithm is within the bounds of get_bounds(), that's, the long-run error
+and the maximum tokens in any 1s window.
+"""
+
+from __future__ import print_function
+
+import time
+import random
+import argparse
+import tracemalloc
+
+from xutils.rate import (GCRA, KeyedRate, SlidingWindowCounter,
+                         SlidingWindowLog, TokenBucket)
+
+
+class _TickBucket(object):
+    """Refill rate // hz tokens every 1 / hz seconds, up to the burst, which
+    is also rate // hz by default, like the old Rate. The burst is at least
+    rate // hz, or the refill would be lost."""
+
+    def __init__(self, rate, burst=None, hz=10):
+        self.rate = rate
+        self._per_tick = max(int(rate // hz), 1)
+        self.burst = max(burst or 0, self._per_tick)
+        self._interval = self._per_tick / float(rate)
+        self._tokens = self.burst
+        self._tick = 0
+
+    def try_acquire(self, n=1, now=0):
+        tick = int(now // self._interval)
+        if tick > self._tick:
+            self._tokens = min(self.burst, self._tokens +
+                               (tick - self._tick) * self._per_tick)
+            self._tick = tick
+        if self._tokens >= n:
+            self._tokens -= n
+            return 0.0
+        return max((tick + 1) * self._interval - now, 1e-9)
+
+
+ALGORITHMS = [
+    ("tick", _TickBucket),
+    ("token_bucket", TokenBucket),
+    ("gcra", GCRA),
+    ("sliding_counter", SlidingWindowCounter),
+    ("sliding_log", SlidingWindowLog),
+]
+
+
+def max_in_window(times, window):
+    """Return the maximum number of the sorted times in any sliding window."""
+
+    best, start = 0, 0
+    for end, now in enumerate(times):
+        while times[start] <= now - window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def run_greedy(limiter, duration, step):
+    """Acquire the tokens greedily by the virtual clock, and return the times."""
+
+    times = []
+    for i in range(int(duration / step)):
+        now = 1000.0 + i * step  # Don't start at 0, like the monotonic clock.
+        while not limiter.try_acquire(1, now):
+            times.append(now - 1000.0)
+    return times
+
+
+def measure(cls, rate, burst, duration, step):
+    """Return the achieved rate, its error in percent, the maximum tokens in
+    any 1s and 100ms window, and in any 1s window after the first second."""
+
+    times = run_greedy(cls(rate, burst), duration, step)
+    # Exclude the initial burst from the long-run rate.
+    steady = [t for t in times if t >= 1]
+    achieved = len(steady) / (duration - 1)
+    return (achieved, (achieved - rate) * 100.0 / rate,
+            max_in_window(times, 1.0), max_in_window(times, 0.1),
+            max_in_window(steady, 1.0))
+
+
+def get_bounds(name, rate, burst):
+    """Return the bounds of the error in percent, the tokens in any 1s window,
+    and the tokens in any 1s window after the first second."""
+
+    if name == "tick":  # It refills burst tokens at once.
+        return (-1, 1), rate + burst, rate + burst
+    elif name == "sliding_counter":
+        # It's approximate, and under-delivers by up to one token per window
+        # of burst / rate seconds, that's, 1 / burst of the rate.
+        return (-100.0 / burst - 1, 1), rate + burst, rate + 1
+    return (-1, 1), rate + burst, rate + 1
+
+
+def bench_deviation(args):
+    rate = args.rate
+    burst = args.burst or max(rate // 10, 1)  # The default of Rate
+    print("rate=%s burst=%s duration=%ss step=%ss" % (
+        rate, burst, args.duration, args.step))
+    print("%-16s %-12s %-10s %-14s %-14s %-14s" % (
+        "algorithm", "tokens/s", "error(%)", "max/1s", "max/100ms",
+        "after 1st s"))
+
+    for name, cls in ALGORITHMS:
+        print("%-16s %-12.1f %-10.2f %-14d %-14d %-14d" % (
+            (name,) + measure(cls, rate, burst, args.duration, args.step)))
+
+
+def check_deviation(args):
+    failures = 0
+    for rate, burst in [(100, None), (100, 1), (100, 100), (1000, None),
+                        (7, None), (7, 7), (50, 25)]:
+        burst = burst or max(rate // 10, 1)
+        for name, cls in ALGORITHMS:
+            achieved, error, max_1s, _, steady_1s = measure(
+                cls, rate, burst, args.duration, args.step)
+            # The tick bucket may raise the burst.
+            (min_error, max_error), bound_1s, bound_steady = get_bounds(
+                name, rate, cls(rate, burst).burst)
+            ok = (min_error <= error <= max_error and max_1s <= bound_1s and
+                  steady_1s <= bound_steady)
+            failures += not ok
+            print("%-4s rate=%-5s burst=%-4s %-16s error=%.2f%% [%.2f, %.2f] "
+                  "max/1s=%d<=%d after 1st s=%d<=%d" % (
+                      "ok" if ok else "FAIL", rate, burst, name, error,
+                      min_error, max_error, max_1s, bound_1s, steady_1s,
+                      bound_steady))
+
+    if failures:
+        raise SystemExit("%d checks failed" % failures)
+
+
+def bench_keyed(args):
+    keys = ["client-%d" % i for i in range(args.keys)]
+    rand = random.Random(args.seed)
+    order = [rand.choice(keys) for _ in range(args.checks)]
+    rates = KeyedRate(args.rate, burst=args.burst, max_keys=args.max_keys)
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    for key in keys:
+        rates.allow(key)
+    fill = time.time() - start
+    memory = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    allow = rates.allow
+    allowed = 0
+    start = time.time()
+    for key in order:
+        if allow(key):
+            allowed += 1
+    elapsed = time.time() - start
+
+    latencies = []
+    for i in range(args.new_keys):
+        key = "new-%d" % i
+        start = time.time()
+        allow(key)
+        latencies.append(time.time() - start)
+    latencies.sort()
+
+    print("keys=%d max_keys=%d rate=%s burst=%s" % (
+        args.keys, rates._max_keys, args.rate, rates.burst))
+    print("remembered keys:  %d" % len(rates))
+    print("state memory:     %.1f MiB, %.1f bytes/key" % (
+        memory / 1048576.0, memory / float(max(len(rates), 1))))
+    print("fill:             %.0f new keys/s (traced)" % (args.keys / fill))
+    print("check:            %.0f checks/s, %.1f%% allowed" % (
+        args.checks / elapsed, allowed * 100.0 / args.checks))
+    if latencies:
+        print("new key:          p50 %.1f us, p99.9 %.1f us, max %.1f us" % (
+            latencies[len(latencies) // 2] * 1e6,
+            latencies[int(len(latencies) * 0.999)] * 1e6,
+            latencies[-1] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xutils.rate.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    keyed = subparsers.add_parser("keyed", help="KeyedRate with many keys")
+    keyed.add_argument("--keys", type=int, default=1000000)
+    keyed.add_argument("--max-keys", type=int, default=None)
+    keyed.add_argument("--checks", type=int, default=1000000)
+    keyed.add_argument("--new-keys", type=int, default=100000)
+    keyed.add_argument("--rate", type=float, default=0.01,
+                       help="the default keeps all the keys remembered")
+    keyed.add_argument("--burst", type=int, default=100)
+    keyed.add_argument("--seed", type=int, default=0)
+    keyed.set_defaults(func=bench_keyed)
+
+    deviation = subparsers.add_parser("deviation", help="the output rate")
+    deviation.add_argument("--rate", type=int, default=100)
+    deviation.add_argument("--burst", type=int, default=None,
+                           help="the default is rate // 10, the same as Rate")
+    deviation.add_argument("--duration", type=float, default=60)
+    deviation.add_argument("--step", type=float, default=0.001)
+    deviation.set_defaults(func=bench_deviation)
+
+    check = subparsers.add_parser("check", help="check the output rate")
+    check.add_argument("--duration", type=float, default=20)
+    check.add_argument("--step", type=float, default=0.001)
+    check.set_defaults(func=check_deviation)
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
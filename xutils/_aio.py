@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""The coroutine helpers of the guards, such as CircuitBreaker, whose modules
+still support Python 2. It requires Python 3.5+, so import it lazily.
+
+The guard has the attribute _expected_exception and the methods below:
+
+    _before_request()                   -> token, raise to reject the call
+    _after_request(token, ok, start)    record the result of the call
+    _cancel_request(token)              the call raised an unexpected exception
+    _timed                              if True, pass the start time
+"""
+
+from functools import wraps
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+async def call(guard, func, args, kwargs):
+    """Await func(*args, **kwargs) inside the accounting of the guard."""
+
+    token = guard._before_request()
+    start = monotonic() if guard._timed else None
+    try:
+        result = await func(*args, **kwargs)
+    except guard._expected_exception:
+        guard._after_request(token, False, start)
+        raise
+    except BaseException:
+        guard._cancel_request(token)
+        raise
+    else:
+        guard._after_request(token, True, start)
+        return result
+
+
+def wrap(guard, wrapped):
+    """Wrap the coroutine function, which is still a coroutine function."""
+
+    @wraps(wrapped)
+    async def wrapper(*args, **kwargs):
+        return await call(guard, wrapped, args, kwargs)
+    return wrapper
+
+
+def wrap_keyed(get_guard, wrapped):
+    """Like wrap, but use the guard returned by get_guard(*args, **kwargs)
+    for each call."""
+
+    @wraps(wrapped)
+    async def wrapper(*args, **kwargs):
+        return await call(get_guard(*args, **kwargs), wrapped, args, kwargs)
+    return wrapper
+
+
+class AsyncContextMixin(object):
+    """Support "async with" by the methods __enter__ and __exit__."""
+
+    __slots__ = ()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return self.__exit__(exc_type, exc_value, traceback)
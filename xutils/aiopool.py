@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""The resource pool based on asyncio, which requires Python 3.5+."""
+
+import time
+import asyncio
+import inspect
+
+from collections import deque
+
+_PLACE = object()  # Handed over to a waiter to create the object by itself.
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class _AsyncResourcePoolSession(object):
+    def __init__(self, pool, obj, close_on_exc=False):
+        self.__pool = pool
+        self.__obj = obj
+        self.__close_on_exc = close_on_exc
+        self.__closed = False
+
+    def __repr__(self):
+        return "AsyncResourcePoolSession(obj={0})".format(self.__obj)
+
+    def __getattr__(self, name):
+        if self.__closed:
+            raise RuntimeError("The session has been closed.")
+
+        return getattr(self.__obj, name)
+
+    def __del__(self):
+        self.release_to_pool()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, ex_type, ex_value, traceback):
+        await self.release(ex_type is not None and self.__close_on_exc)
+
+    def release_to_pool(self):
+        """Release the obj into the resource pool without blocking."""
+
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__pool._put_nowait(self.__obj)
+
+    async def release(self, close=False):
+        """Release the obj into the resource pool.
+
+        If close is True, close it at first, then release its place in the
+        resource pool.
+        """
+
+        if self.__closed:
+            return
+        self.__closed = True
+
+        obj, self.__obj = self.__obj, None
+        if close:
+            await self.__pool._close_obj(obj)
+            obj = None
+        self.__pool._put_nowait(obj)
+
+    async def close(self):
+        await self.release(close=True)
+
+
+class AsyncResourcePool(object):
+    def __init__(self, factory, capacity=0, idle_timeout=None, autowrap=False,
+                 close_on_exc=False, close_func=None, **factory_kwargs):
+        """Create a new pool object based on asyncio.
+
+        @param factory(callable): The function or coroutine function to create
+                                  the object, which is called with factory_kwargs.
+        @param capacity(int): The maximum capacity of the pool.
+                              If 0, the capacity is infinite.
+        @param idle_timeout(int): The idle timeout. The unit is second.
+                                  If None or 0, never time out.
+        @param autowrap(bool): If True, it will wrap the obj in a session
+                               automatically, which will release the obj into
+                               the pool when the session is closed or deleted.
+        @param close_on_exc(bool): If True and autowrap is True, in async with
+                                   context, the session will close the obj
+                                   when an exception is raised.
+        @param close_func(callable): The function or coroutine function to
+                                     close the object. If None, call the method
+                                     close of the object, and await it if need.
+
+        Example:
+        >>> pool = AsyncResourcePool(open_connection, capacity=100, autowrap=True)
+        >>> async def handle():
+        ...     async with await pool.get(timeout=1) as conn:
+        ...         await conn.execute("...")
+        """
+
+        self._factory = factory
+        self._kwargs = factory_kwargs
+        self._close_func = close_func
+
+        self._closed = False
+        self._capacity = capacity if capacity >= 0 else 0
+        self._timeout = idle_timeout
+        self._autowrap = autowrap
+        self._close_on_exc = close_on_exc
+
+        self._size = 0            # The number of all the objects, idle and in use.
+        self._idle = deque()      # The idle objects, each is (obj, putting_time).
+        self._waiters = deque()   # The futures of the coroutines waiting for objects.
+                                  # Each is set to (obj,), _PLACE, or None if closed.
+
+    def _get_now(self):
+        return time.monotonic()
+
+    def _is_expired(self, puttime, now):
+        return self._timeout and now - puttime > self._timeout
+
+    async def _create(self):
+        return await _maybe_await(self._factory(**self._kwargs))
+
+    async def _close_obj(self, obj):
+        if obj is None:
+            return
+
+        try:
+            if self._close_func:
+                await _maybe_await(self._close_func(obj))
+            else:
+                await _maybe_await(obj.close())
+        except Exception:
+            pass
+
+    def _has_waiters(self):
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+        return bool(self._waiters)
+
+    def _hand_over(self, result):
+        """Hand the object or the place over to the first waiter directly,
+        so that it cannot be taken by a later coroutine. Return False if no
+        coroutine is waiting."""
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(result)
+                return True
+        return False
+
+    async def close(self):
+        """Close the pool and release all the objects.
+
+        When closed, the waiting coroutines will raise a RuntimeError.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+
+        idle, self._idle = self._idle, deque()
+        self._size -= len(idle)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+        for obj, _ in idle:
+            await self._close_obj(obj)
+
+    async def get(self, timeout=None):
+        """Get an object from the pool.
+
+        When the pool is closed, it will raise a RuntimeError if calling this
+        method.
+
+        If the capacity is limited and no object is available in timeout
+        seconds, it will raise asyncio.TimeoutError. The waiting coroutines
+        are served in the FIFO order.
+        """
+
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            if self._closed:
+                raise RuntimeError("The pool has been closed.")
+
+            # Don't jump ahead of the coroutines which are waiting.
+            if not self._has_waiters():
+                now = self._get_now()
+                while self._idle:
+                    obj, puttime = self._idle.popleft()
+                    if not self._is_expired(puttime, now):
+                        return self._wrap(obj)
+                    self._size -= 1
+                    await self._close_obj(obj)
+
+                if not self._capacity or self._size < self._capacity:
+                    self._size += 1
+                    return await self._create_in_place()
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                result = await asyncio.wait_for(waiter, remaining)
+            except BaseException:
+                # Pass what has been handed over to the next waiter.
+                if waiter.done() and not waiter.cancelled():
+                    self._give_back(waiter.result())
+                raise
+            finally:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+            if result is None or self._closed:
+                self._give_back(result)
+            elif result is _PLACE:
+                return await self._create_in_place()
+            else:
+                return self._wrap(result[0])
+
+    async def _create_in_place(self):
+        try:
+            obj = await self._create()
+        except BaseException:
+            self._release_place()
+            raise
+        return self._wrap(obj)
+
+    def _give_back(self, result):
+        if result is _PLACE:
+            self._release_place()
+        elif result is not None:
+            self._put_nowait(result[0])
+
+    def _wrap(self, obj):
+        if self._autowrap:
+            return _AsyncResourcePoolSession(self, obj, self._close_on_exc)
+        return obj
+
+    def _release_place(self):
+        if not self._closed and not self._hand_over(_PLACE):
+            self._size -= 1
+
+    def _put_nowait(self, obj):
+        """Put the object back to the pool. If obj is None, only release
+        its place.
+
+        If the pool has been closed, the object will be closed in a new task.
+        """
+
+        if obj is None:
+            self._release_place()
+        elif self._closed:
+            try:
+                asyncio.ensure_future(self._close_obj(obj))
+            except RuntimeError:  # No event loop
+                pass
+        elif not self._hand_over((obj,)):
+            self._idle.append((obj, self._get_now()))
+
+    async def put(self, obj):
+        """Put an object into the pool.
+
+        When the pool is closed, it will close the object, not put it into the
+        pool, if calling this method. None is ignored.
+        """
+
+        if obj is None:
+            return
+        elif isinstance(obj, _AsyncResourcePoolSession):
+            await obj.release()
+        elif self._closed:
+            await self._close_obj(obj)
+        else:
+            self._put_nowait(obj)
+
+    async def put_with_close(self, obj):
+        if obj is None:
+            return
+        elif isinstance(obj, _AsyncResourcePoolSession):
+            await obj.close()
+        else:
+            await self._close_obj(obj)
+            self._release_place()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""The rate limiter based on asyncio, which requires Python 3.5+."""
+
+import asyncio
+
+from collections import deque
+
+from xutils.rate import TokenBucket, monotonic
+
+
+class AsyncRate(object):
+    def __init__(self, rate, hz=10, burst=None, algorithm=None):
+        """The rate limiter for asyncio.
+
+        The arguments are the same as xutils.rate.Rate.
+
+        The coroutines waiting for the tokens are served in the FIFO order,
+        and the waiting one is woken by a timer when the tokens of the first
+        one are available, without polling. It should be used in one event
+        loop.
+
+        Example:
+        >>> rate = AsyncRate(10)
+        >>> async def crawl(url):
+        ...     await rate.get_token()
+        ...     return await fetch(url)
+        """
+
+        if rate < 1 or hz < 1:
+            raise ValueError("rate and hz must be a positive integer")
+
+        burst = burst or max(int(rate // hz), 1)
+        self._bucket = (algorithm or TokenBucket)(rate, burst)
+        self._waiters = deque()  # Each is (future, n)
+        self._timer = None
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    @property
+    def burst(self):
+        return self._bucket.burst
+
+    def _check(self, n):
+        if n < 1 or n > self._bucket.burst:
+            raise ValueError("n must be between 1 and the burst %s"
+                             % self._bucket.burst)
+
+    def _has_waiters(self):
+        while self._waiters and self._waiters[0][0].done():
+            self._waiters.popleft()
+        return bool(self._waiters)
+
+    def allow(self, n=1):
+        """Return True if there are n tokens and no coroutine is waiting,
+        or False. It never be blocked."""
+
+        self._check(n)
+        return not self._has_waiters() and not self._bucket.try_acquire(n)
+
+    async def get_token(self, n=1, timeout=None):
+        """Acquire n tokens, and wait until they are available.
+
+        If timeout is not None, wait for at most timeout seconds, and return
+        False if the tokens cannot be acquired in time. Return True if acquired.
+
+        If the waiting coroutine is cancelled, it gives up its place in the
+        queue, and the next ones are not held up.
+        """
+
+        self._check(n)
+        if not self._has_waiters() and not self._bucket.try_acquire(n):
+            return True
+        if timeout is not None and timeout <= 0:
+            return False
+
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self._waiters.append((waiter, n))
+        expiry = None
+        if timeout is not None:
+            expiry = loop.call_later(timeout, self._expire, waiter)
+        if len(self._waiters) == 1:
+            self._wakeup()
+
+        try:
+            return await waiter
+        finally:
+            if expiry is not None:
+                expiry.cancel()
+            if not waiter.done() or waiter.cancelled() or not waiter.result():
+                waiter.cancel()
+                self._wakeup()  # The first waiter may be gone.
+
+    def _expire(self, waiter):
+        if not waiter.done():
+            waiter.set_result(False)
+            self._wakeup()
+
+    def _wakeup(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        waiters = self._waiters
+        while waiters:
+            waiter, n = waiters[0]
+            if waiter.done():
+                waiters.popleft()
+                continue
+
+            delay = self._bucket.try_acquire(n, monotonic())
+            if delay:
+                loop = asyncio.get_event_loop()
+                self._timer = loop.call_later(delay, self._wakeup)
+                return
+
+            waiters.popleft()
+            waiter.set_result(True)
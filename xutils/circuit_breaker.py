@@ -1,9 +1,32 @@
 # -*- coding: utf8 -*-
 
+import sys
+import struct
+import logging
+import itertools
+
 from time import time
-from threading import Lock
+from collections import deque, OrderedDict
+from weakref import WeakSet
+from threading import Lock, local
 from functools import wraps
 
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
+
+if sys.version_info[:2] >= (3, 5):
+    from inspect import iscoroutinefunction
+    from xutils import _aio
+    _AsyncContextMixin = _aio.AsyncContextMixin
+else:
+    iscoroutinefunction = lambda func: False
+    _aio = None  # Never used, because nothing is a coroutine function.
+    _AsyncContextMixin = object
+
+LOG = logging.getLogger(__name__)
+
 STATE_CLOSED = "closed"
 STATE_OPEN = "open"
 STATE_HALF_OPEN = "half-open"
@@ -57,14 +80,59 @@ class Count(object):
         self.consecutive_failures = 0
 
     def copy(self):
-        c = self.__class__.__new__()
+        c = self.__class__.__new__(self.__class__)
         c.requests = self.requests
-        c.total_successes = c.total_successes
-        c.total_failures = c.total_failures
-        c.consecutive_successes = c.consecutive_successes
-        c.consecutive_failures = c.consecutive_failures
+        c.total_successes = self.total_successes
+        c.total_failures = self.total_failures
+        c.consecutive_successes = self.consecutive_successes
+        c.consecutive_failures = self.consecutive_failures
         return c
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _Stripe(object):
+    """The counters of the successful calls in the closed state, which are
+    only updated by one thread without any lock."""
+
+    __slots__ = ("generation", "requests", "successes", "__weakref__")
+
+    def __init__(self):
+        self.generation = 0
+        self.requests = 0
+        self.successes = 0
+
+
+class _Permit(_AsyncContextMixin):
+    """The callback returned by CircuitBreaker.allow(), which may be used as
+    the context manager by "with" or "async with"."""
+
+    __slots__ = ("_breaker", "_generation", "_start", "_done")
+
+    def __init__(self, breaker, generation, start):
+        self._breaker = breaker
+        self._generation = generation
+        self._start = start
+        self._done = False
+
+    def __call__(self, ok):
+        if not self._done:
+            self._done = True
+            self._breaker._after_request(self._generation, ok, self._start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self(True)
+        elif issubclass(exc_type, self._breaker._expected_exception):
+            self(False)
+        elif not self._done:
+            self._done = True
+            self._breaker._cancel_request(self._generation)
+
 
 class CircuitBreaker(object):
     MAX_REQUESTS = 1
@@ -73,6 +141,14 @@ class CircuitBreaker(object):
     FAILURE_THRESHOLD = 5
     EXPECTED_EXCEPTION = Exception
 
+    # If True, the successful calls in the closed state are counted by the
+    # per-thread counters without the lock, which are aggregated lazily.
+    # The subclasses which must see every call under the lock disable it.
+    FAST_PATH = True
+
+    # If True, time each call and pass its duration to the callbacks.
+    _timed = False
+
     def __init__(self, name=None, max_requests=None, count_interval=None,
                  recovery_timeout=None, failure_threshold=None,
                  expected_exception=None, on_state_change=None):
@@ -87,12 +163,29 @@ class CircuitBreaker(object):
         self._expected_exception = expected_exception or self.EXPECTED_EXCEPTION
         self._on_state_change = on_state_change
 
+        self._fast_path = self.FAST_PATH
+        self._local = local()
+        self._stripes = WeakSet()
+        self._succeeded = False  # A call succeeded by the fast path.
+
+        self._rejected_open = 0       # The calls rejected in the open state.
+        self._rejected_half_open = 0  # The calls rejected in the half-open state.
+        self._transitions = 0         # The number of the state changes.
+
+        self._init_state()
+
+    def _init_state(self):
+        """Initialize the state and the lock protecting it.
+
+        The subclass may override it to store the state elsewhere.
+        """
+
         self._state = STATE_CLOSED
+        self._since = time()
         self._generation = 0
         self._count = Count()
         self._expiry = 0
         self._lock = Lock()
-
         self._new_generation(get_now())
 
     @property
@@ -131,7 +224,38 @@ class CircuitBreaker(object):
         """Return the count information of the requests."""
 
         with self._lock:
-            return self._count.copy()
+            return self._copy_count()
+
+    def _copy_count(self):
+        count = self._count.copy()
+        for stripe in list(self._stripes):
+            if stripe.generation == self._generation:
+                count.requests += stripe.requests
+                count.total_successes += stripe.successes
+        return count
+
+    def snapshot(self):
+        """Return the consistent snapshot of the circuit breaker as a dict.
+
+        The keys are "name", "state", "since" (the time when the state was
+        changed, by time.time()), "time_in_state" (in seconds), "transitions",
+        "rejected_open", "rejected_half_open", and the fields of Count, which
+        are counted in the current state or count interval.
+        """
+
+        with self._lock:
+            now = time()
+            self._current_state(int(now))
+            return self._snapshot(now)
+
+    def _snapshot(self, now):
+        info = self._copy_count().to_dict()
+        info.update(name=self._name, state=self._state, since=self._since,
+                    time_in_state=max(now - self._since, 0),
+                    transitions=self._transitions,
+                    rejected_open=self._rejected_open,
+                    rejected_half_open=self._rejected_half_open)
+        return info
 
     def __call__(self, wrapped):
         """Decorate the function or method.
@@ -143,9 +267,12 @@ class CircuitBreaker(object):
         if not self._name:
             self._name = wrapped.__name__
 
-        @wraps(wrapped)
-        def wrapper(*args, **kwargs):
-            return self.call(wrapped, *args, **kwargs)
+        if iscoroutinefunction(wrapped):
+            wrapper = _aio.wrap(self, wrapped)
+        else:
+            @wraps(wrapped)
+            def wrapper(*args, **kwargs):
+                return self.call(wrapped, *args, **kwargs)
 
         CircuitBreakerMonitor.register(self)
         return wrapper
@@ -157,10 +284,21 @@ class CircuitBreaker(object):
         or failure in a separate step.
 
         If the circuit breaker doesn't allow requests, it raises an exception.
+
+        The callback is also a context manager, which registers the success
+        if no exception is raised, or the failure if the expected exception
+        is raised. On Python 3.5+, it supports "async with" as well.
+
+        Example:
+        >>> with breaker.allow():
+        ...     do_request()
+        >>> async with breaker.allow():
+        ...     await do_async_request()
         """
 
         generation = self._before_request()
-        return lambda ok: self._after_request(generation, ok)
+        start = monotonic() if self._timed else None
+        return _Permit(self, generation, start)
 
     def call(self, func, *args, **kwargs):
         """Run the given request if the CircuitBreaker accepts it.
@@ -170,39 +308,88 @@ class CircuitBreaker(object):
 
         If an exception is raised in the request, the CircuitBreaker handles it
         as a failure and reraises it again.
+
+        If func is a coroutine function, it returns a coroutine, which should
+        be awaited and runs func inside the accounting.
         """
 
+        if iscoroutinefunction(func):
+            return _aio.call(self, func, args, kwargs)
+
         generation = self._before_request()
+        start = monotonic() if self._timed else None
         try:
             result = func(*args, **kwargs)
         except self._expected_exception:
-            self._after_request(generation, False)
+            self._after_request(generation, False, start)
+            raise
+        except BaseException:
+            self._cancel_request(generation)
             raise
         else:
-            self._after_request(generation, True)
+            self._after_request(generation, True, start)
             return result
 
+    def _get_stripe(self):
+        try:
+            return self._local.stripe
+        except AttributeError:
+            stripe = self._local.stripe = _Stripe()
+            with self._lock:
+                self._stripes.add(stripe)
+            return stripe
+
     def _before_request(self):
+        if self._fast_path:
+            # Read the generation before the state, which are changed in the
+            # reverse order. If the state changes meanwhile, the generation is
+            # stale and the result of the call will be ignored.
+            generation = self._generation
+            expiry = self._expiry
+            if self._state == STATE_CLOSED and (not expiry or get_now() <= expiry):
+                stripe = self._get_stripe()
+                if stripe.generation != generation:
+                    stripe.generation = generation
+                    stripe.requests = stripe.successes = 0
+                stripe.requests += 1
+                return generation
+
         with self._lock:
             now = get_now()
             state, generation = self._current_state(now)
             if state == STATE_OPEN:
+                self._rejected_open += 1
                 raise OpenStateError
             elif state == STATE_HALF_OPEN and self._count.requests >= self._max_requests:
+                self._rejected_half_open += 1
                 raise TooManyRequestsError
 
             self._count.on_request()
             return generation
 
-    def _after_request(self, before_generation, ok):
+    def _after_request(self, before_generation, ok, start=None):
+        if ok and self._fast_path and self._state == STATE_CLOSED:
+            expiry = self._expiry
+            if self._generation == before_generation and \
+                    (not expiry or get_now() <= expiry):
+                stripe = self._get_stripe()
+                if stripe.generation == before_generation:
+                    stripe.successes += 1
+                    self._succeeded = True
+                    return
+
+        duration = None if start is None else monotonic() - start
         with self._lock:
             now = get_now()
             state, generation = self._current_state(now)
             if generation != before_generation:
                 return
-            (self._on_success if ok else self._on_failure)(state, now)
+            (self._on_success if ok else self._on_failure)(state, now, duration)
 
-    def _on_success(self, state, now):
+    def _cancel_request(self, before_generation):
+        """The call raised an unexpected exception, which is ignored."""
+
+    def _on_success(self, state, now, duration=None):
         if state == STATE_CLOSED:
             self._count.on_success()
         elif state == STATE_HALF_OPEN:
@@ -210,8 +397,11 @@ class CircuitBreaker(object):
             if self._count.consecutive_successes >= self._max_requests:
                 self._set_statue(STATE_CLOSED, now)
 
-    def _on_failure(self, state, now):
+    def _on_failure(self, state, now, duration=None):
         if state == STATE_CLOSED:
+            if self._succeeded:  # Break the consecutive failures.
+                self._succeeded = False
+                self._count.consecutive_failures = 0
             self._count.on_failure()
             if self._count.consecutive_failures > self._failure_threshold:
                 self._set_statue(STATE_OPEN, now)
@@ -234,13 +424,17 @@ class CircuitBreaker(object):
             return
 
         prev, self._state = self._state, state
+        self._since = time()
+        self._transitions += 1
         self._new_generation(now)
+        CircuitBreakerMonitor._add_event(self._name, prev, state, self._since)
         if self._on_state_change:
             self._on_state_change(self._name, prev, state)
 
     def _new_generation(self, now):
         self._generation += 1
         self._count.clear()
+        self._succeeded = False
 
         state = self._state
         if state == STATE_CLOSED:
@@ -251,15 +445,607 @@ class CircuitBreaker(object):
             self._expiry = 0
 
 
+_OUTCOME_FAILURE = 1
+_OUTCOME_SLOW = 2
+
+
+class CountWindow(object):
+    """The sliding window of the outcomes of the last size calls.
+
+    It is a ring buffer, and the cost to record a call is O(1).
+    """
+
+    def __init__(self, size=100):
+        if size < 1:
+            raise ValueError("size must be a positive integer")
+
+        self._size = size
+        self.reset()
+
+    def reset(self):
+        self._ring = [None] * self._size
+        self._index = 0
+        self.requests = 0
+        self.failures = 0
+        self.slows = 0
+
+    def record(self, failure, now=None, slow=False):
+        old = self._ring[self._index]
+        if old is None:
+            self.requests += 1
+        else:
+            if old & _OUTCOME_FAILURE:
+                self.failures -= 1
+            if old & _OUTCOME_SLOW:
+                self.slows -= 1
+
+        outcome = 0
+        if failure:
+            outcome |= _OUTCOME_FAILURE
+            self.failures += 1
+        if slow:
+            outcome |= _OUTCOME_SLOW
+            self.slows += 1
+
+        self._ring[self._index] = outcome
+        self._index = (self._index + 1) % self._size
+
+    def advance(self, now):
+        """Only for the compatibility with TimeWindow."""
+
+
+class TimeWindow(object):
+    """The sliding window of the outcomes of the calls in the last duration
+    seconds, which is split into some buckets.
+
+    It is a ring buffer of the buckets, and the cost to record a call is O(1).
+    """
+
+    def __init__(self, duration=60, buckets=10):
+        if duration <= 0 or buckets < 1:
+            raise ValueError("duration and buckets must be positive")
+
+        self._buckets = buckets
+        self._width = float(duration) / buckets
+        self.reset()
+
+    def reset(self):
+        self._requests = [0] * self._buckets
+        self._failures = [0] * self._buckets
+        self._slows = [0] * self._buckets
+        self._epoch = None  # The sequence number of the current bucket
+        self.requests = 0
+        self.failures = 0
+        self.slows = 0
+
+    def advance(self, now):
+        """Move the window to now, and drop the expired buckets."""
+
+        epoch = int(now // self._width)
+        if self._epoch is not None and epoch <= self._epoch:
+            return
+
+        start = epoch - self._buckets + 1
+        if self._epoch is not None:
+            start = max(start, self._epoch + 1)
+        for i in range(start, epoch + 1):
+            i %= self._buckets
+            self.requests -= self._requests[i]
+            self.failures -= self._failures[i]
+            self.slows -= self._slows[i]
+            self._requests[i] = self._failures[i] = self._slows[i] = 0
+        self._epoch = epoch
+
+    def record(self, failure, now, slow=False):
+        self.advance(now)
+        i = self._epoch % self._buckets
+        self._requests[i] += 1
+        self.requests += 1
+        if failure:
+            self._failures[i] += 1
+            self.failures += 1
+        if slow:
+            self._slows[i] += 1
+            self.slows += 1
+
+
+class WindowedCircuitBreaker(CircuitBreaker):
+    FAST_PATH = False
+    FAILURE_RATE_THRESHOLD = 50
+    MINIMUM_REQUESTS = 10
+    SLOW_CALL_RATE_THRESHOLD = 100
+
+    def __init__(self, name=None, window=None, failure_rate_threshold=None,
+                 minimum_requests=None, slow_call_duration=None,
+                 slow_call_rate_threshold=None, **kwargs):
+        """The Circuit Breaker, which opens when the failure rate or the slow
+        call rate of the calls in the sliding window reaches the threshold.
+
+        @param window(CountWindow, TimeWindow): The sliding window of the calls.
+                                                The default is CountWindow(100).
+        @param failure_rate_threshold(int): The threshold of the failure rate
+                                            in percentage, such as 50 for 50%.
+        @param minimum_requests(int): The minimum number of the calls in the
+                                      window before the failure rate is checked.
+        @param slow_call_duration(float): The call which takes at least
+                                          slow_call_duration seconds is slow.
+                                          If None, don't time the calls.
+        @param slow_call_rate_threshold(int): The threshold of the slow call
+                                              rate in percentage.
+
+        The call is timed by a monotonic clock, from the start of call() or
+        allow() to the end of the call or the callback. In the half-open state,
+        a slow call is handled as a failure.
+
+        The other arguments are the same as CircuitBreaker, but count_interval
+        and failure_threshold are not used.
+        """
+
+        self._window = window or CountWindow()
+        self._failure_rate_threshold = failure_rate_threshold or \
+            self.FAILURE_RATE_THRESHOLD
+        self._minimum_requests = minimum_requests or self.MINIMUM_REQUESTS
+        self._slow_call_duration = slow_call_duration
+        self._slow_call_rate_threshold = slow_call_rate_threshold or \
+            self.SLOW_CALL_RATE_THRESHOLD
+        self._timed = slow_call_duration is not None
+        kwargs.pop("count_interval", None)
+        super(WindowedCircuitBreaker, self).__init__(name, **kwargs)
+
+    @property
+    def failure_rate(self):
+        """Return the failure rate in percentage of the calls in the window."""
+
+        return self._rate("failures")
+
+    @property
+    def slow_call_rate(self):
+        """Return the slow call rate in percentage of the calls in the window."""
+
+        return self._rate("slows")
+
+    def _rate(self, attr):
+        with self._lock:
+            self._window.advance(monotonic())
+            if not self._window.requests:
+                return 0.0
+            return getattr(self._window, attr) * 100.0 / self._window.requests
+
+    def _snapshot(self, now):
+        info = super(WindowedCircuitBreaker, self)._snapshot(now)
+        window = self._window
+        window.advance(monotonic())
+        info.update(window_requests=window.requests,
+                    window_failures=window.failures,
+                    window_slows=window.slows)
+        return info
+
+    def _is_slow(self, duration):
+        return duration is not None and duration >= self._slow_call_duration
+
+    def _on_success(self, state, now, duration=None):
+        slow = self._is_slow(duration)
+        if state == STATE_CLOSED:
+            self._count.on_success()
+            self._window.record(False, monotonic(), slow)
+            if slow and self._should_trip():
+                self._set_statue(STATE_OPEN, now)
+        elif slow:
+            super(WindowedCircuitBreaker, self)._on_failure(state, now)
+        else:
+            super(WindowedCircuitBreaker, self)._on_success(state, now)
+
+    def _on_failure(self, state, now, duration=None):
+        if state == STATE_CLOSED:
+            self._count.on_failure()
+            self._window.record(True, monotonic(), self._is_slow(duration))
+            if self._should_trip():
+                self._set_statue(STATE_OPEN, now)
+        else:
+            super(WindowedCircuitBreaker, self)._on_failure(state, now)
+
+    def _should_trip(self):
+        window = self._window
+        requests = window.requests
+        if requests < self._minimum_requests:
+            return False
+        return (window.failures * 100 >= self._failure_rate_threshold * requests or
+                (self._timed and
+                 window.slows * 100 >= self._slow_call_rate_threshold * requests))
+
+    def _new_generation(self, now):
+        super(WindowedCircuitBreaker, self)._new_generation(now)
+        if self._state == STATE_CLOSED:
+            self._window.reset()
+
+
+_STATE_CODES = {STATE_CLOSED: 0, STATE_OPEN: 1, STATE_HALF_OPEN: 2}
+_CODE_STATES = {code: state for state, code in _STATE_CODES.items()}
+
+
+class _SharedState(object):
+    """The lock of SharedCircuitBreaker, which loads the state from the shared
+    memory into the breaker when acquired, and stores it back when released."""
+
+    MAGIC = b"XCB2"
+
+    # magic, state, since, generation, expiry, and the fields of Count.
+    LAYOUT = struct.Struct("<4sBdQd5Q")
+
+    def __init__(self, breaker, shm):
+        self._breaker = breaker
+        self._shm = shm
+
+    def __enter__(self):
+        self._shm.__enter__()
+        try:
+            self._load()
+        except BaseException:
+            self._shm.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self._store()
+        finally:
+            self._shm.__exit__(exc_type, exc_value, traceback)
+
+    def _load(self):
+        cb = self._breaker
+        values = self._shm.unpack(self.LAYOUT)
+        if values[0] != self.MAGIC:  # The first process initializes it.
+            cb._state, cb._since = STATE_CLOSED, time()
+            cb._generation, cb._expiry = 0, 0
+            cb._count.clear()
+            cb._new_generation(get_now())
+            return
+
+        cb._state = _CODE_STATES[values[1]]
+        cb._since, cb._generation, cb._expiry = values[2:5]
+        count = cb._count
+        (count.requests, count.total_successes, count.total_failures,
+         count.consecutive_successes, count.consecutive_failures) = values[5:]
+
+    def _store(self):
+        cb, count = self._breaker, self._breaker._count
+        self._shm.pack(self.LAYOUT, (
+            self.MAGIC, _STATE_CODES[cb._state], cb._since, cb._generation,
+            cb._expiry,
+            count.requests, count.total_successes, count.total_failures,
+            count.consecutive_successes, count.consecutive_failures))
+
+
+class SharedCircuitBreaker(CircuitBreaker):
+    FAST_PATH = False
+
+    def __init__(self, path, name=None, **kwargs):
+        """The Circuit Breaker whose state, counts and generation are shared by
+        all the processes on the host, such as the prefork workers of gunicorn,
+        so that all of them open together when the backend is down.
+
+        @param path(str): The path of the file as the shared memory, which
+                          should be different for each circuit breaker,
+                          such as "/dev/shm/myapp-cb-backend".
+
+        The other arguments are the same as CircuitBreaker, which should be
+        the same for all the processes. It requires fcntl, see xutils.shm.
+
+        Notice: on_state_change is only called, and the state change is only
+        added into the event log of CircuitBreakerMonitor, in the process which
+        changes the state. And the rejected counters are counted per process.
+        """
+
+        self._path = path
+        super(SharedCircuitBreaker, self).__init__(name, **kwargs)
+
+    def _init_state(self):
+        from xutils.shm import SharedMemory
+
+        self._state = STATE_CLOSED
+        self._since = time()
+        self._generation = 0
+        self._count = Count()
+        self._expiry = 0
+        self._lock = _SharedState(self, SharedMemory(self._path,
+                                                     _SharedState.LAYOUT.size))
+        with self._lock:
+            pass
+
+
+if hasattr(OrderedDict, "move_to_end"):
+    _move_to_end = OrderedDict.move_to_end
+else:
+    def _move_to_end(d, key):
+        d[key] = d.pop(key)
+
+
+class KeyedCircuitBreaker(object):
+    MAX_KEYS = 1000
+
+    # The number of the least recently used breakers to look for a closed one
+    # when evicting, to bound the cost.
+    EVICTION_SCAN = 16
+
+    def __init__(self, name=None, cls=CircuitBreaker, max_keys=None,
+                 key_idle_timeout=None, key_func=None, register=False, **kwargs):
+        """The circuit breakers per key, such as the upstream host or endpoint,
+        which are created lazily from the same configuration.
+
+        @param name(str): The name, which is the prefix of the names of the
+                          circuit breakers, that's, "name:key".
+        @param cls(CircuitBreaker or subclass): The class of the breakers,
+                                                which is called with kwargs.
+        @param max_keys(int): The maximum number of the breakers. When reached,
+                              evict the least recently used one, and prefer the
+                              closed one, which has no state worth keeping.
+        @param key_idle_timeout(int): If not None, the breaker which has not
+                                      been used for key_idle_timeout seconds
+                                      will be evicted, even if it's open,
+                                      because no call will close it. So it
+                                      should be longer than recovery_timeout.
+        @param key_func(callable): The function to get the key from the
+                                   arguments of the decorated function.
+                                   It's required by the decorator.
+        @param register(bool): If True, register the breakers into
+                               CircuitBreakerMonitor, and unregister them
+                               when evicted.
+
+        Example:
+        >>> breakers = KeyedCircuitBreaker("upstream", max_keys=10000,
+        ...                                failure_threshold=10)
+        >>> breakers.call(host, requests.get, url)
+        """
+
+        self._name = name
+        self._cls = cls
+        self._kwargs = kwargs
+        self._max_keys = max_keys or self.MAX_KEYS
+        self._key_idle_timeout = key_idle_timeout
+        self._key_func = key_func
+        self._register = register
+
+        self._lock = Lock()
+        self._breakers = OrderedDict()  # key -> [breaker, last_used]
+        self._evictions = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    def __len__(self):
+        return len(self._breakers)
+
+    def __contains__(self, key):
+        return key in self._breakers
+
+    def keys(self):
+        with self._lock:
+            return list(self._breakers.keys())
+
+    def get(self, key):
+        """Return the circuit breaker of the key, which is created if need."""
+
+        now = monotonic()
+        with self._lock:
+            entry = self._breakers.get(key)
+            if entry is not None:
+                entry[1] = now
+                _move_to_end(self._breakers, key)
+                return entry[0]
+
+            self._evict(now)
+            breaker = self._cls(name=self._get_name(key), **self._kwargs)
+            self._breakers[key] = [breaker, now]
+            if self._register:
+                CircuitBreakerMonitor.register(breaker)
+            return breaker
+
+    __getitem__ = get
+
+    def _get_name(self, key):
+        return "%s:%s" % (self._name, key) if self._name else str(key)
+
+    def _evict(self, now):
+        breakers = self._breakers
+        if self._key_idle_timeout:
+            before = now - self._key_idle_timeout
+            while breakers:
+                key, (_, last_used) = next(iter(breakers.items()))
+                if last_used > before:
+                    break
+                self._remove(key)
+
+        if len(breakers) < self._max_keys:
+            return
+
+        victim = None
+        for i, (key, (breaker, _)) in enumerate(breakers.items()):
+            if victim is None:
+                victim = key
+            if breaker.is_closed:
+                victim = key
+                break
+            elif i + 1 >= self.EVICTION_SCAN:
+                break
+        self._remove(victim)
+
+    def _remove(self, key):
+        breaker = self._breakers.pop(key)[0]
+        self._evictions += 1
+        if self._register:
+            CircuitBreakerMonitor.unregister(breaker)
+
+    def remove(self, key):
+        """Remove the circuit breaker of the key, and return it or None."""
+
+        with self._lock:
+            if key not in self._breakers:
+                return None
+            breaker = self._breakers[key][0]
+            self._remove(key)
+            return breaker
+
+    def snapshot(self):
+        """Return the snapshots of all the circuit breakers as a dict,
+        whose key is the key of the breaker."""
+
+        with self._lock:
+            items = [(key, entry[0]) for key, entry in self._breakers.items()]
+        return {key: breaker.snapshot() for key, breaker in items}
+
+    def allow(self, key):
+        """The same as CircuitBreaker.allow() of the breaker of the key."""
+
+        return self.get(key).allow()
+
+    def call(self, key, func, *args, **kwargs):
+        """The same as CircuitBreaker.call() of the breaker of the key."""
+
+        return self.get(key).call(func, *args, **kwargs)
+
+    def __call__(self, wrapped):
+        """Decorate the function or method, which uses the breaker of the key
+        returned by key_func(*args, **kwargs) of each call."""
+
+        if self._key_func is None:
+            raise ValueError("key_func is required by the decorator")
+
+        if iscoroutinefunction(wrapped):
+            get_key = self._key_func
+            return _aio.wrap_keyed(lambda *a, **kw: self.get(get_key(*a, **kw)),
+                                   wrapped)
+        else:
+            @wraps(wrapped)
+            def wrapper(*args, **kwargs):
+                breaker = self.get(self._key_func(*args, **kwargs))
+                return breaker.call(wrapped, *args, **kwargs)
+        return wrapper
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
 class CircuitBreakerMonitor(object):
     circuit_breakers = {}
 
+    # The log of the recent state changes, each of which is a tuple,
+    # (seq, timestamp, name, prev_state, state).
+    events = deque(maxlen=1000)
+    _event_seq = itertools.count(1)
+
+    @classmethod
+    def _add_event(cls, name, prev, state, timestamp):
+        cls.events.append((next(cls._event_seq), timestamp, name, prev, state))
+
+    @classmethod
+    def set_event_log_size(cls, size):
+        """Set the maximum number of the events kept in the event log.
+
+        The default is 1000. The newest events are kept if it is shrunk.
+        """
+
+        if size < 1:
+            raise ValueError("size must be a positive integer")
+
+        # The events are always added to CircuitBreakerMonitor, not cls.
+        monitor = CircuitBreakerMonitor
+        monitor.events = deque(monitor.events, maxlen=size)
+
+    @classmethod
+    def get_events(cls, after=0):
+        """Return the state changes in the event log whose seq is greater than
+        after, from the oldest to the newest.
+
+        The poller may pass the seq of the last event that it has seen, so it
+        only gets the new ones.
+        """
+
+        return [event for event in list(cls.events) if event[0] > after]
+
+    @classmethod
+    def snapshot(cls):
+        """Return the snapshots of all the circuit breakers as a list in one pass,
+        each of which is returned by CircuitBreaker.snapshot().
+        """
+
+        return [cb.snapshot() for cb in list(cls.circuit_breakers.values())]
+
+    @classmethod
+    def render_prometheus(cls, prefix="circuit_breaker", snapshots=None):
+        """Render the snapshots of all the circuit breakers in the Prometheus
+        text exposition format, and return it as a string.
+
+        @param prefix(str): The prefix of the metric names.
+        @param snapshots(list): The snapshots to be rendered.
+                                If None, use the result of snapshot().
+        """
+
+        if snapshots is None:
+            snapshots = cls.snapshot()
+
+        metrics = [
+            ("state", "gauge", "Whether the circuit breaker is in the state."),
+            ("state_seconds", "gauge", "The time in the current state."),
+            ("transitions_total", "counter", "The number of the state changes."),
+            ("rejected_total", "counter", "The number of the rejected calls."),
+            ("requests", "gauge", "The calls in the current state or interval."),
+            ("successes", "gauge", "The successful calls in the current state or interval."),
+            ("failures", "gauge", "The failed calls in the current state or interval."),
+        ]
+        samples = {name: [] for name, _, _ in metrics}
+        for info in snapshots:
+            label = 'name="%s"' % _escape_label(info["name"])
+            for state in (STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN):
+                samples["state"].append(('%s,state="%s"' % (label, state),
+                                         int(info["state"] == state)))
+            samples["state_seconds"].append((label, info["time_in_state"]))
+            samples["transitions_total"].append((label, info["transitions"]))
+            samples["rejected_total"].append(
+                (label + ',reason="open"', info["rejected_open"]))
+            samples["rejected_total"].append(
+                (label + ',reason="half_open"', info["rejected_half_open"]))
+            samples["requests"].append((label, info["requests"]))
+            samples["successes"].append((label, info["total_successes"]))
+            samples["failures"].append((label, info["total_failures"]))
+
+        lines = []
+        for metric, metric_type, metric_help in metrics:
+            name = "%s_%s" % (prefix, metric)
+            lines.append("# HELP %s %s" % (name, metric_help))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in samples[metric]:
+                lines.append("%s{%s} %s" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
     @classmethod
     def register(cls, cb):
-        """Register a circuit breaker."""
+        """Register a circuit breaker.
+
+        If another circuit breaker has been registered with the same name,
+        it will be replaced with a warning.
+        """
 
+        old = cls.circuit_breakers.get(cb.name)
+        if old is not None and old is not cb:
+            LOG.warning("Replace the registered circuit breaker named '%s'",
+                        cb.name)
         cls.circuit_breakers[cb.name] = cb
 
+    @classmethod
+    def unregister(cls, cb):
+        """Unregister the circuit breaker, and return True if it's registered.
+
+        cb is the circuit breaker or its name.
+        """
+
+        if isinstance(cb, CircuitBreaker):
+            if cls.circuit_breakers.get(cb.name) is not cb:
+                return False
+            cb = cb.name
+        return cls.circuit_breakers.pop(cb, None) is not None
+
     @classmethod
     def all_closed(cls):
         """Return True if all circuit breakers are closed."""
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""The adaptive concurrency limiter, that's, the bulkhead, which caps the
+in-flight calls to a dependency and adapts the cap to the observed latency.
+
+Different from CircuitBreaker, which is open or closed, it sheds the load
+beyond the capacity of the dependency, and rejects the call fast instead of
+queueing it when the limit is reached.
+"""
+
+import math
+
+from threading import Lock
+from functools import wraps
+
+from xutils.circuit_breaker import (CircuitBreakerError, _Permit, _aio,
+                                    iscoroutinefunction, monotonic)
+
+
+class LimitExceededError(CircuitBreakerError):
+    pass
+
+
+class AIMDLimit(object):
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000,
+                 backoff_ratio=0.9, timeout=None):
+        """The Additive-Increase/Multiplicative-Decrease algorithm.
+
+        @param initial_limit(int): The initial limit.
+        @param min_limit(int): The minimum limit.
+        @param max_limit(int): The maximum limit.
+        @param backoff_ratio(float): When a call fails or times out, multiply
+                                     the limit by it.
+        @param timeout(float): The call which takes more than timeout seconds
+                               is handled as a failure. If None, ignore it.
+
+        When the call succeeds and at least half of the limit is in use,
+        increase the limit by 1. Like TCP, back off at most once per round
+        trip, that's, ignore the failures of the calls which started before
+        the last backoff.
+        """
+
+        if not 0 < backoff_ratio < 1:
+            raise ValueError("backoff_ratio must be in (0, 1)")
+
+        self.limit = initial_limit
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._backoff_ratio = backoff_ratio
+        self._timeout = timeout
+        self._last_backoff = 0
+
+    def update(self, rtt, inflight, ok):
+        """Update the limit by the sample of a call, and return it.
+
+        @param rtt(float): The duration of the call in seconds.
+        @param inflight(int): The number of the in-flight calls when it started.
+        @param ok(bool): Whether the call succeeded.
+        """
+
+        limit = self.limit
+        if not ok or (self._timeout and rtt > self._timeout):
+            now = monotonic()
+            if now - rtt < self._last_backoff:
+                return limit
+            self._last_backoff = now
+            limit = int(limit * self._backoff_ratio)
+        elif inflight * 2 >= limit:
+            limit += 1
+
+        self.limit = min(max(limit, self._min_limit), self._max_limit)
+        return self.limit
+
+
+class GradientLimit(object):
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000,
+                 smoothing=0.2, rtt_tolerance=1.5, long_window=600,
+                 queue_size=None):
+        """The gradient algorithm, like TCP Vegas, which compares the latency
+        of the recent call with the long-term one to estimate the queueing.
+
+        @param initial_limit(int): The initial limit.
+        @param min_limit(int): The minimum limit.
+        @param max_limit(int): The maximum limit.
+        @param smoothing(float): The weight of the new limit, in (0, 1].
+        @param rtt_tolerance(float): How much the latency may grow over the
+                                     long-term latency before decreasing the
+                                     limit, such as 1.5 for 50%.
+        @param long_window(int): The number of the samples that the long-term
+                                 latency, the exponential moving average,
+                                 is over.
+        @param queue_size(callable): The function taking the limit and
+                                     returning the allowance of the queueing,
+                                     which makes the limit grow. The default is
+                                     the square root of the limit, at least 4.
+
+        The new limit is limit * gradient + queue_size(limit), where gradient
+        is rtt_tolerance * long_rtt / rtt, limited to [0.5, 1.0].
+        """
+
+        if not 0 < smoothing <= 1:
+            raise ValueError("smoothing must be in (0, 1]")
+
+        self.limit = initial_limit
+        self._estimated = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._smoothing = smoothing
+        self._rtt_tolerance = rtt_tolerance
+        self._long_window = long_window
+        self._queue_size = queue_size or (lambda limit: max(4, int(math.sqrt(limit))))
+
+        self._long_rtt = 0.0
+        self._samples = 0
+
+    @property
+    def long_rtt(self):
+        return self._long_rtt
+
+    def _update_long_rtt(self, rtt):
+        # Warm up with the simple average, then switch to the moving average.
+        self._samples += 1
+        if self._samples <= self._long_window:
+            self._long_rtt += (rtt - self._long_rtt) / self._samples
+        else:
+            self._long_rtt += (rtt - self._long_rtt) * 2.0 / (self._long_window + 1)
+
+        # Let the long-term latency drift down fast when the dependency
+        # recovers, which allows the limit to grow again.
+        if self._long_rtt > rtt * 2:
+            self._long_rtt *= 0.95
+
+    def update(self, rtt, inflight, ok):
+        """Update the limit by the sample of a call, and return it.
+
+        The arguments are the same as AIMDLimit.update().
+        """
+
+        if not ok or rtt <= 0:  # A failure is often fast, so ignore its latency.
+            return self.limit
+
+        self._update_long_rtt(rtt)
+
+        # The dependency is not the bottleneck if the limit is not in use.
+        estimated = self._estimated
+        if inflight * 2 < estimated:
+            return self.limit
+
+        gradient = max(0.5, min(1.0, self._rtt_tolerance * self._long_rtt / rtt))
+        new = estimated * gradient + self._queue_size(estimated)
+        new = estimated * (1 - self._smoothing) + new * self._smoothing
+        self._estimated = min(max(new, self._min_limit), self._max_limit)
+        self.limit = int(self._estimated)
+        return self.limit
+
+
+class ConcurrencyLimiter(object):
+    EXPECTED_EXCEPTION = Exception
+
+    _timed = True
+
+    def __init__(self, name=None, algorithm=None, expected_exception=None,
+                 on_limit_change=None):
+        """The adaptive concurrency limiter.
+
+        @param name(str): The name of the limiter.
+        @param algorithm(AIMDLimit, GradientLimit): The algorithm to adapt the
+                                                    limit. The default is
+                                                    GradientLimit().
+        @param expected_exception(Exception): The exception which means that
+                                              the call fails. The other
+                                              exceptions are ignored.
+        @param on_limit_change(callable): If not None, it will be called with
+                                          the name, the old limit and the new
+                                          limit when the limit changes.
+
+        If the number of the in-flight calls reaches the limit, the new call
+        is rejected with LimitExceededError immediately. The API is the same
+        as CircuitBreaker, that's, call(), allow() and the decorator.
+
+        Example:
+        >>> limiter = ConcurrencyLimiter("backend", AIMDLimit(timeout=0.5))
+        >>> @limiter
+        ... def request():
+        ...     pass
+        """
+
+        self._name = name
+        self._algorithm = algorithm or GradientLimit()
+        self._expected_exception = expected_exception or self.EXPECTED_EXCEPTION
+        self._on_limit_change = on_limit_change
+
+        self._lock = Lock()
+        self._inflight = 0
+        self._rejected = 0
+
+    @property
+    def name(self):
+        """Return the name of the limiter."""
+
+        return self._name
+
+    @property
+    def limit(self):
+        """Return the current limit of the in-flight calls."""
+
+        return self._algorithm.limit
+
+    @property
+    def inflight(self):
+        """Return the number of the in-flight calls."""
+
+        return self._inflight
+
+    def snapshot(self):
+        """Return the snapshot of the limiter as a dict, whose keys are "name",
+        "limit", "inflight" and "rejected"."""
+
+        with self._lock:
+            return {"name": self._name, "limit": self._algorithm.limit,
+                    "inflight": self._inflight, "rejected": self._rejected}
+
+    def __call__(self, wrapped):
+        """Decorate the function or method."""
+
+        if not self._name:
+            self._name = wrapped.__name__
+
+        if iscoroutinefunction(wrapped):
+            return _aio.wrap(self, wrapped)
+
+        @wraps(wrapped)
+        def wrapper(*args, **kwargs):
+            return self.call(wrapped, *args, **kwargs)
+        return wrapper
+
+    def allow(self):
+        """Acquire a place of the in-flight calls, and return a callback that
+        should be called with whether the call succeeds to release the place.
+
+        The callback is also a context manager by "with" or "async with",
+        the same as CircuitBreaker.allow().
+
+        If the limit is reached, it raises LimitExceededError.
+        """
+
+        token = self._before_request()
+        return _Permit(self, token, monotonic())
+
+    def call(self, func, *args, **kwargs):
+        """Run the given call if the limit is not reached, and return its result.
+
+        If func is a coroutine function, it returns a coroutine.
+        """
+
+        if iscoroutinefunction(func):
+            return _aio.call(self, func, args, kwargs)
+
+        token = self._before_request()
+        start = monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except self._expected_exception:
+            self._after_request(token, False, start)
+            raise
+        except BaseException:
+            self._cancel_request(token)
+            raise
+        else:
+            self._after_request(token, True, start)
+            return result
+
+    def _before_request(self):
+        with self._lock:
+            if self._inflight >= self._algorithm.limit:
+                self._rejected += 1
+                raise LimitExceededError
+            self._inflight += 1
+            return self._inflight  # The in-flight calls when the call starts
+
+    def _after_request(self, inflight, ok, start):
+        rtt = monotonic() - start
+        with self._lock:
+            self._inflight -= 1
+            old = self._algorithm.limit
+            new = self._algorithm.update(rtt, inflight, ok)
+
+        if new != old and self._on_limit_change:
+            self._on_limit_change(self._name, old, new)
+
+    def _cancel_request(self, inflight):
+        with self._lock:
+            self._inflight -= 1
@@ -1,9 +1,140 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import types
+import logging
+import weakref
+import functools
+import itertools
 
-from queue import Queue, Empty
-from threading import Lock
+from bisect import bisect_left
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Event, Lock, Thread, local
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+LOG = logging.getLogger(__name__)
+
+STRATEGY_FIFO = "fifo"
+STRATEGY_LIFO = "lifo"
+
+# The session only makes the method calls of the obj faster. Reading its
+# data attributes is a little slower, and it is released in the same way.
+AUTOWRAP_FAST = "fast"
+
+# The result of ResourcePool._acquire() when there is no idle object,
+# or of ResourcePool._try_create() when there is no place.
+_EMPTY = object()
+
+_now = getattr(time, "monotonic", time.time)
+_fork_lock = Lock()
+
+
+class _CurrentPid(object):
+    """_current_pid[0] is the pid of the current process."""
+
+    def __getitem__(self, index):
+        return os.getpid()
+
+
+if hasattr(os, "register_at_fork"):  # Python 3.7+
+    # Cache the pid to avoid the system call on the hot path.
+    _current_pid = [os.getpid()]
+
+    def _update_current_pid():
+        _current_pid[0] = os.getpid()
+
+    os.register_at_fork(after_in_child=_update_current_pid)
+else:
+    _current_pid = _CurrentPid()
+
+
+class _Histogram(object):
+    """The histogram of the durations in second with the fixed buckets."""
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Return the dict with the cumulative buckets like Prometheus."""
+
+        total, buckets = 0, []
+        for bound, count in zip(self.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"count": total, "sum": self.sum, "buckets": buckets}
+
+
+class _PoolStats(object):
+    __slots__ = ("hits", "misses", "waits", "timeouts", "created",
+                 "create_failures", "closed", "idle_evictions", "invalid",
+                 "wait_time", "hold_time", "borrowed")
+
+    def __init__(self):
+        self.hits = 0               # Borrow an idle object.
+        self.misses = 0             # Borrow a new object.
+        self.waits = 0              # Have to wait for an object.
+        self.timeouts = 0           # Fail to borrow an object in time.
+        self.created = 0
+        self.create_failures = 0
+        self.closed = 0
+        self.idle_evictions = 0     # Close the object which has been idle too long.
+        self.invalid = 0            # Close the object failing the validation.
+        self.wait_time = _Histogram()
+        self.hold_time = _Histogram()
+        self.borrowed = {}          # id(obj) -> the time when it is borrowed.
+
+    def snapshot(self, size, idle, waiting):
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "waiting": waiting,
+            "borrows": self.hits + self.misses,
+            "hits": self.hits,
+            "misses": self.misses,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "created": self.created,
+            "create_failures": self.create_failures,
+            "closed": self.closed,
+            "idle_evictions": self.idle_evictions,
+            "invalid": self.invalid,
+            "wait_time": self.wait_time.snapshot(),
+            "hold_time": self.hold_time.snapshot(),
+        }
+
+
+def _merge_stats(snapshots):
+    result = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if key not in result:
+                result[key] = value
+            elif isinstance(value, dict):  # Histogram
+                merged = result[key]
+                result[key] = {
+                    "count": merged["count"] + value["count"],
+                    "sum": merged["sum"] + value["sum"],
+                    "buckets": [(b, c1 + c2) for (b, c1), (_, c2) in
+                                zip(merged["buckets"], value["buckets"])],
+                }
+            else:
+                result[key] += value
+    return result
 
 
 class _ResourcePoolSession(object):
@@ -42,22 +173,100 @@ class _ResourcePoolSession(object):
             return
         self.__closed = True
 
-        if close:
-            try:
-                self.__obj.close()
-            except Exception:
-                pass
-            self.__obj = None
-
-        self.__pool._put_from_session(self.__obj)
+        obj, self.__obj = self.__obj, None
+        self.__pool._put_from_session(obj, close)
 
     def close(self):
         self.release_to_pool(close=True)
 
 
+_METHOD_TYPES = (types.MethodType, types.BuiltinMethodType)
+
+
+class _FastResourcePoolSession(_ResourcePoolSession):
+    """The session caching the bound methods of the obj in itself after they
+    are accessed at first, so calling them costs nothing more than calling
+    them on the obj directly.
+
+    The data attributes are not cached, because they may be changed, so
+    reading them costs a little more than by the normal session.
+
+    The cached methods are dropped when the session is released, so it is
+    recommended to release it explicitly, such as by the with context.
+    Like the normal session, it is only released by __del__ otherwise.
+    """
+
+    def __getattr__(self, name):
+        if self._ResourcePoolSession__closed:
+            raise RuntimeError("The session has been closed.")
+
+        obj = self._ResourcePoolSession__obj
+        value = getattr(obj, name)
+
+        # Only cache the methods bound to the obj. Check the type at first,
+        # which is cheaper than looking up __self__ of the data attributes.
+        if type(value) in _METHOD_TYPES and value.__self__ is obj:
+            self.__dict__[name] = value
+        return value
+
+    def release_to_pool(self, close=False):
+        for name in [n for n in self.__dict__ if not n.startswith("_ResourcePoolSession__")]:
+            del self.__dict__[name]
+        _ResourcePoolSession.release_to_pool(self, close)
+
+
+def _get_session_class(autowrap):
+    if autowrap == AUTOWRAP_FAST:
+        return _FastResourcePoolSession
+    return _ResourcePoolSession if autowrap else None
+
+
+def _start_reaper(pool, interval):
+    """Start a daemon thread to call pool.reap() every interval seconds
+    if interval is not None or 0, and return the event to stop it."""
+
+    stopped = Event()
+    if interval:
+        thread = Thread(target=_reap_forever,
+                        args=(weakref.ref(pool), interval, stopped))
+        thread.daemon = True
+        thread.start()
+    return stopped
+
+
+def _reset_after_fork(pool):
+    """Call pool._after_fork() once in the child process after forking.
+
+    The locks and the objects inherited from the parent process cannot be
+    used by the child process, and the reaper thread does not exist in it.
+    """
+
+    with _fork_lock:
+        if pool._pid != _current_pid[0]:
+            pool._after_fork()
+            pool._pid = _current_pid[0]
+
+
+def _reap_forever(ref, interval, stopped):
+    # Only hold a weak reference to the pool, so that the reaper thread does
+    # not prevent the pool from being collected by GC.
+    while not stopped.wait(interval):
+        pool = ref()
+        if pool is None:
+            return
+
+        try:
+            pool.reap()
+        except Exception as err:
+            LOG.error("Failed to reap the resource pool: %s", err)
+        del pool
+
+
 class ResourcePool(object):
     def __init__(self, cls, capacity=0, idle_timeout=None, autowrap=False,
-                 close_on_exc=False, **cls_kwargs):
+                 close_on_exc=False, min_idle=0, max_idle=0, max_size=None,
+                 reap_interval=None, validate=None, test_on_borrow=True,
+                 test_while_idle=False, strategy=STRATEGY_FIFO, **cls_kwargs):
         """Create a new pool object.
 
         @param cls(object): The object class to be manage.
@@ -70,9 +279,39 @@ class ResourcePool(object):
         @param autowrap(bool): If True, it will wrap the obj in ResourcePoolSession
                                automatically, which will release the obj into the
                                pool when the session is closed or deleted.
+                               If AUTOWRAP_FAST, the session caches the bound
+                               methods of the obj to call them faster. It only
+                               helps the method calls, but reading the data
+                               attributes is a little slower than True, and
+                               the session is still released only by close(),
+                               release_to_pool(), with context or __del__.
         @param close_on_exc(bool): If True and autowrap is True, in with context,
                                    the session will close the obj firstly,
                                    then new an new one into the pool.
+        @param min_idle(int): The minimum number of the idle objects, which
+                              the reaper will create in advance.
+        @param max_idle(int): The maximum number of the idle objects. If more
+                              objects are put back, they will be closed.
+                              If 0, it is limited only by max_size.
+        @param max_size(int): The maximum number of the objects, both idle
+                              and in use. If None, use capacity instead.
+        @param reap_interval(int): If given, start a background daemon thread
+                                   to call reap() every reap_interval seconds.
+        @param validate(callable): The function to check whether the object is
+                                   still usable, which is called with the object
+                                   and should return True or False.
+        @param test_on_borrow(bool): If True, validate the idle object by the
+                                     function validate before returning it
+                                     by get(). The invalid one is closed.
+        @param test_while_idle(bool): If True, validate the idle objects by
+                                      the function validate in reap().
+        @param strategy(str): The order to borrow the idle objects.
+                              STRATEGY_FIFO borrows the least recently
+                              returned one, which cycles through all the
+                              objects. STRATEGY_LIFO borrows the most recently
+                              returned one, so that the hot objects stay warm
+                              and the pool shrinks to the working set with
+                              idle_timeout and reap_interval.
 
         Example:
         >>> import time
@@ -95,30 +334,105 @@ class ResourcePool(object):
         >>> pool.put(obj2)
         >>> obj3 = pool.get()  # You has no need to put it back to pool.
         >>>                    # It will put it back automatically when released by GC.
+
+        The pool creates the objects lazily, so call warmup() to create them
+        concurrently in advance.
+
+        The pool may be created before forking, such as by gunicorn with
+        preload_app or xutils.process.ProcessManager. In the child process,
+        the objects inherited from the parent are dropped without being closed
+        when the pool is used at first, and the new ones are created instead.
         """
 
-        capacity = capacity if capacity >= 0 else 0
+        if strategy not in (STRATEGY_FIFO, STRATEGY_LIFO):
+            raise ValueError("unknown strategy '%s'" % strategy)
+
+        max_size = capacity if max_size is None else max_size
+        max_size = max_size if max_size >= 0 else 0
+        max_idle = max_idle if max_idle >= 0 else 0
+        if max_size and (not max_idle or max_idle > max_size):
+            max_idle = max_size
+        if max_idle and min_idle > max_idle:
+            min_idle = max_idle
 
         self._cls = cls
         self._kwargs = cls_kwargs
 
         self._closed = False
         self._lock = Lock()
-        self._capacity = capacity
+        self._cond = Condition(self._lock)
+        self._capacity = max_size
+        self._min_idle = max(min_idle, 0)
+        self._max_idle = max_idle
         self._timeout = idle_timeout
-        self._pools = Queue(capacity)
-        self._autowrap = autowrap
+        self._session_cls = _get_session_class(autowrap)
         self._close_on_exc = close_on_exc
+        self._validate = validate
+        self._test_on_borrow = test_on_borrow and validate is not None
+        self._test_while_idle = test_while_idle and validate is not None
+        self._lifo = strategy == STRATEGY_LIFO
+
+        self._size = 0          # The number of all the objects, idle and in use.
+        self._idle = deque()    # The idle objects, each is (obj, putting_time).
+        self._waiting = 0       # The number of the threads waiting for objects.
+        self._stats = _PoolStats()
+        self._inherited = set() # The ids of the objects borrowed before forking.
 
-        while capacity > 0:
-            self.put(None)
-            capacity -= 1
+        self._pid = _current_pid[0]
+        self._reap_interval = reap_interval
+        self._reaper_stopped = _start_reaper(self, reap_interval)
 
     def __del__(self):
-        self.close()
+        if hasattr(self, "_reaper_stopped"):  # __init__ may have failed.
+            self.close()
+
+    def _after_fork(self):
+        # Drop the objects inherited from the parent process without closing
+        # them, because they are still used by the parent process.
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._inherited.update(self._stats.borrowed)
+        self._idle = deque()
+        self._size = 0
+        self._waiting = 0
+        self._stats = _PoolStats()
+        if not self._closed:
+            self._reaper_stopped = _start_reaper(self, self._reap_interval)
+
+    def _adopt(self, obj):
+        # The inherited object has been freed if its id is reused by the new
+        # object, so forget it, or the new one would be dropped when put back.
+        if self._inherited:
+            self._inherited.discard(id(obj))
 
     def _get_now(self):
-        return int(time.time())
+        return _now()
+
+    def _is_expired(self, puttime, now):
+        return self._timeout and now - puttime > self._timeout
+
+    def _create(self, deadline=None, prefill=False):
+        """Create a new object.
+
+        deadline is the deadline of get(), and prefill is True if the object
+        is created in advance by warmup() or reap().
+        """
+
+        return self._cls(**self._kwargs)
+
+    def _on_destroy(self, num):
+        """It is called without the lock after num objects created by _create()
+        are closed and their places are released."""
+
+    def _is_valid(self, obj):
+        try:
+            return bool(self._validate(obj))
+        except Exception:
+            return False
+
+    def _discard(self, obj, invalid=False):
+        self._close_obj(obj)
+        self._release(None, closed=obj, invalid=invalid)
 
     def _close_obj(self, obj):
         if obj:
@@ -127,75 +441,974 @@ class ResourcePool(object):
             except Exception:
                 pass
 
+    def _close_objs(self, objs):
+        for obj in objs:
+            self._close_obj(obj)
+
     def close(self):
         """Close the pool and release all the objects.
 
         When closed, it will raise an RuntimeError if putting an object into it.
         """
 
-        with self._lock:
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            idle = self._shutdown()
+        self._close_idle(idle)
+
+    def _shutdown(self):
+        """Mark the pool closed and take out all the idle objects.
+
+        It must be called with the lock, and return None if it has been closed.
+        """
+
+        if self._closed:
+            return None
+        self._closed = True
+        self._reaper_stopped.set()
+
+        idle, self._idle = self._idle, deque()
+        self._size -= len(idle)
+        self._stats.closed += len(idle)
+        self._cond.notify_all()
+        return idle
+
+    def _close_idle(self, idle):
+        if idle:
+            self._close_objs(obj for obj, _ in idle)
+            self._on_destroy(len(idle))
+
+    def reap(self):
+        """Close the expired idle objects, then create the new ones in advance
+        until the number of the idle objects reaches min_idle.
+
+        It is called by the reaper thread if reap_interval is given, so the
+        request path will pay for neither eviction nor cold creation.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        expired = []
+        with self._cond:
             if self._closed:
                 return
-            self._closed = True
 
-        while True:
+            if self._timeout and self._idle:
+                now = self._get_now()
+                idle = deque()
+                for item in self._idle:
+                    if self._is_expired(item[1], now):
+                        expired.append(item[0])
+                    else:
+                        idle.append(item)
+
+                if expired:
+                    self._idle = idle
+                    self._size -= len(expired)
+                    self._stats.closed += len(expired)
+                    self._stats.idle_evictions += len(expired)
+                    if self._waiting:
+                        self._cond.notify(len(expired))
+
+            num = self._min_idle - len(self._idle)
+            if self._capacity:
+                num = min(num, self._capacity - self._size)
+            num = max(num, 0)
+            self._size += num
+            self._stats.created += num
+
+        if expired:
+            self._close_objs(expired)
+            self._on_destroy(len(expired))
+        if self._test_while_idle:
+            self._validate_idle()
+        self._fill(num)
+
+    def _validate_idle(self):
+        with self._cond:
+            items = list(self._idle)
+
+        # Take out and validate the idle objects one by one from the newest
+        # to the oldest, so that the borrowers are not blocked for long and
+        # the order of the idle objects is kept.
+        for item in reversed(items):
+            with self._cond:
+                try:
+                    self._idle.remove(item)
+                except ValueError:  # It has been borrowed.
+                    continue
+
+            if not self._is_valid(item[0]):
+                self._discard(item[0], invalid=True)
+                continue
+
+            with self._cond:
+                if not self._closed:
+                    self._idle.appendleft(item)
+                    self._cond.notify()
+                    continue
+            self._close_obj(item[0])
+
+    def _try_create(self, _=None):
+        try:
+            return self._create(prefill=True)
+        except Empty:  # The shared capacity is full, such as keyed.
+            return _EMPTY
+        except Exception as err:
+            LOG.error("Failed to create the object for the pool: %s", err)
+            return None
+
+    def _fill(self, num, workers=None):
+        """Create num objects concurrently, and put them into the pool.
+
+        The places of the objects must have been reserved.
+        """
+
+        if num <= 0:
+            return 0
+        elif num == 1:
+            objs = [self._try_create()]
+        else:
+            pool = ThreadPool(min(workers or num, num))
             try:
-                self._close_obj(self._pools.get_nowait()[0])
-                self._pools.task_done()
-            except Empty:
-                return
+                objs = pool.map(self._try_create, range(num))
+            finally:
+                pool.close()
+                pool.join()
+
+        created = 0
+        for obj in objs:
+            if obj is _EMPTY:
+                self._release(None, skipped=True)
+                continue
+            elif obj is not None:
+                created += 1
+                self._adopt(obj)
+            self._release(obj)
+        return created
+
+    def warmup(self, num=None, workers=None):
+        """Create the objects concurrently in the thread pool, and put them
+        into the pool in advance.
+
+        @param num(int): The number of the objects to be created. If None,
+                         use the capacity, or min_idle if the capacity is
+                         infinite. It is limited by the capacity and max_idle.
+        @param workers(int): The number of the threads. If None, use num.
+
+        Return the number of the objects created successfully.
+        """
+
+        if num is None:
+            num = self._capacity or self._min_idle
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The pool has been closed.")
+
+            if self._max_idle:
+                num = min(num, self._max_idle - len(self._idle))
+            if self._capacity:
+                num = min(num, self._capacity - self._size)
+            num = max(num, 0)
+            self._size += num
+            self._stats.created += num
+
+        return self._fill(num, workers)
+
+    def stats(self):
+        """Return the snapshot of the statistics of the pool as a dict.
+
+        It contains the current numbers of the objects ("size", "idle",
+        "in_use") and the waiting threads ("waiting"), the total counters
+        since the pool is created, and two histograms, "wait_time" for
+        borrowing and "hold_time" from borrowing to putting back.
+        The unit of the time is second.
+
+        Each histogram is a dict like {"count": 10, "sum": 0.2, "buckets":
+        [(0.0001, 2), ..., ("+Inf", 10)]}, and the buckets are cumulative.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            return self._stats.snapshot(self._size, len(self._idle),
+                                        self._waiting)
 
     def get(self, timeout=None):
         """Get an object from the pool.
 
         When the pool is closed, it will raise a RuntimeError if calling this
         method.
+
+        If the capacity is limited and no object is available in timeout
+        seconds, it will raise queue.Empty.
         """
 
-        with self._lock:
+        deadline = None if timeout is None else time.time() + timeout
+        obj = self._get(deadline, start=_now())
+        if self._session_cls:
+            return self._session_cls(self, obj, self._close_on_exc)
+        return obj
+
+    def _get(self, deadline, create=True, start=None, probe=False):
+        """Get an idle object, or create a new one if create is True.
+
+        Return _EMPTY if create is False and there is no idle object.
+        start is the time when starting to borrow, which is used by stats.
+        If probe is True, the waits and timeouts are not counted by stats.
+        """
+
+        while True:
+            obj = self._acquire(deadline, create, start, probe)
+            if obj is None:
+                try:
+                    obj = self._create(deadline)
+                except Empty:  # Timed out waiting for the shared capacity.
+                    self._release(None, timed_out=not probe)
+                    raise
+                except Exception:
+                    self._release(None)
+                    raise
+                self._adopt(obj)
+                self._stats.borrowed[id(obj)] = _now()
+                return obj
+            elif obj is not _EMPTY and self._test_on_borrow and \
+                    not self._is_valid(obj):
+                self._discard(obj, invalid=True)
+                continue
+            return obj
+
+    def _acquire(self, deadline, create=True, start=None, probe=False):
+        """Take an idle object from the pool.
+
+        Return None if no idle object, and a place has been reserved for
+        the new object, which should be created by the caller. But return
+        _EMPTY instead if create is False.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        expired = []
+        waited = False
+        stats = self._stats
+        try:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("The pool has been closed.")
+
+                    now = self._get_now()
+                    while self._idle:
+                        if self._lifo:
+                            obj, puttime = self._idle.pop()
+                        else:
+                            obj, puttime = self._idle.popleft()
+
+                        if not self._is_expired(puttime, now):
+                            stats.hits += 1
+                            stats.borrowed[id(obj)] = now
+                            if start is not None:
+                                stats.wait_time.observe(now - start)
+                            return obj
+
+                        expired.append(obj)
+                        self._size -= 1
+                        stats.closed += 1
+                        stats.idle_evictions += 1
+
+                    if not create:
+                        if expired and self._waiting:
+                            self._cond.notify(len(expired))
+                        return _EMPTY
+
+                    if not self._capacity or self._size < self._capacity:
+                        self._size += 1
+                        stats.misses += 1
+                        stats.created += 1
+                        if start is not None:
+                            stats.wait_time.observe(now - start)
+                        return None
+
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            if not probe:
+                                stats.timeouts += 1
+                            raise Empty
+
+                    if not waited and not probe:
+                        waited = True
+                        stats.waits += 1
+
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+        finally:
+            if expired:
+                self._close_objs(expired)
+                self._on_destroy(len(expired))
+
+    def _release(self, obj, num=1, closed=None, invalid=False,
+                 timed_out=False, skipped=False):
+        """Put the object back to the pool.
+
+        If obj is None, only release the place of the object, which has been
+        closed if closed is given, or failed to be created. If timed_out is
+        True, the creation is counted as a timeout instead of a failure.
+        If skipped is True, it is not counted at all.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        if self._inherited and (obj is not None or closed is not None):
+            borrowed = id(obj if obj is not None else closed)
+            if borrowed in self._inherited:
+                self._inherited.discard(borrowed)  # Belong to the parent process.
+                return
+
+        stats = self._stats
+        with self._cond:
+            now = self._get_now()
+            borrowed = obj if obj is not None else closed
+            if borrowed is not None:
+                borrowed = stats.borrowed.pop(id(borrowed), None)
+                if borrowed is not None:
+                    stats.hold_time.observe(now - borrowed)
+
+            if obj is not None and not self._closed and \
+                    (not self._max_idle or len(self._idle) < self._max_idle):
+                self._idle.append((obj, now))
+                if self._waiting:
+                    self._cond.notify()
+                return
+
+            destroyed = num
+            if obj is None and closed is None:
+                destroyed = 0
+                stats.created -= num
+                if timed_out:
+                    stats.timeouts += num
+                elif not skipped:
+                    stats.create_failures += num
+            else:
+                stats.closed += 1
+                if invalid:
+                    stats.invalid += 1
+
             if self._closed:
-                raise RuntimeError("The pool has been closed.")
+                destroyed = 0
+            else:
+                self._size -= num
+                if self._waiting:
+                    self._cond.notify(num)
+
+        self._close_obj(obj)
+        if destroyed:
+            self._on_destroy(destroyed)
+
+    def put(self, obj):
+        """Put an object into the pool.
+
+        When the pool is closed, it will close the object, not put it into the
+        pool, if calling this method. None is ignored.
+        """
+
+        if obj is None:
+            return
+        elif isinstance(obj, _ResourcePoolSession):
+            obj.release_to_pool()
+        else:
+            self._release(obj)
+
+    def put_with_close(self, obj):
+        if obj is None:
+            return
+        elif isinstance(obj, _ResourcePoolSession):
+            obj.close()
+        else:
+            self._discard(obj)
+
+    def _put_from_session(self, obj, close=False):
+        if close:
+            self._discard(obj)
+        else:
+            self._release(obj)
+
+
+class ShardedResourcePool(object):
+    STEAL_INTERVAL = 0.005
+
+    def __init__(self, cls, shards=8, capacity=0, autowrap=False,
+                 close_on_exc=False, min_idle=0, max_idle=0, max_size=None,
+                 reap_interval=None, **kwargs):
+        """Create a new pool object, which is split into some shards to reduce
+        the lock contention among lots of threads.
+
+        Each shard is a ResourcePool, and each thread is bound to a shard.
+        A thread borrows the object from its own shard at first, then steals
+        it from the other shards on miss. The object is always put back to
+        the shard where it is borrowed.
+
+        @param shards(int): The number of the shards. It is limited by the
+                            capacity if the capacity is not infinite.
+
+        capacity, min_idle and max_idle are split among the shards, and
+        the other arguments are the same as ResourcePool.
+
+        Example:
+        >>> pool = ShardedResourcePool(Connection, shards=16, capacity=64)
+        >>> conn = pool.get()
+        >>> pool.put(conn)
+        """
+
+        max_size = capacity if max_size is None else max_size
+        max_size = max_size if max_size >= 0 else 0
+        shards = max(min(shards, max_size) if max_size else shards, 1)
+
+        def _split(total, i):
+            return total // shards + (1 if i < total % shards else 0)
+
+        def _split_at_least_one(total, i):
+            return max(_split(total, i), 1) if total > 0 else 0
+
+        self._shards = [ResourcePool(cls,
+                                     max_size=_split_at_least_one(max_size, i),
+                                     min_idle=_split(min_idle, i),
+                                     max_idle=_split_at_least_one(max_idle, i),
+                                     **kwargs)
+                        for i in range(shards)]
+
+        self._closed = False
+        self._session_cls = _get_session_class(autowrap)
+        self._close_on_exc = close_on_exc
+        self._owners = {}  # The shards of the borrowed objects, id(obj) -> shard
+        self._inherited = set()  # The ids of the objects borrowed before forking.
+        self._lock = Lock()
+        self._waits = 0
+        self._timeouts = 0
+        self._local = local()
+        self._counter = itertools.count()
+
+        self._pid = _current_pid[0]
+        self._reap_interval = reap_interval
+        self._reaper_stopped = _start_reaper(self, reap_interval)
+
+    def __del__(self):
+        if hasattr(self, "_reaper_stopped"):  # __init__ may have failed.
+            self.close()
+
+    def _after_fork(self):
+        # The ids of the objects in the child process may be reused by others.
+        self._inherited.update(self._owners)
+        self._owners = {}
+        self._lock = Lock()
+        self._waits = 0
+        self._timeouts = 0
+        if not self._closed:
+            self._reaper_stopped = _start_reaper(self, self._reap_interval)
+
+    def _get_shard_index(self):
+        try:
+            return self._local.index
+        except AttributeError:
+            index = self._local.index = next(self._counter) % len(self._shards)
+            return index
+
+    def close(self):
+        """Close all the shards and release all the objects."""
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+        if self._closed:
+            return
+        self._closed = True
+        self._reaper_stopped.set()
+
+        for shard in self._shards:
+            shard.close()
+
+    def stats(self):
+        """Return the sum of the statistics of all the shards.
+
+        See ResourcePool.stats().
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        stats = _merge_stats(shard.stats() for shard in self._shards)
+        with self._lock:
+            stats["waits"] += self._waits
+            stats["timeouts"] += self._timeouts
+        return stats
+
+    def reap(self):
+        """Call reap() of all the shards."""
+
+        for shard in self._shards:
+            shard.reap()
+
+    def warmup(self, num=None, workers=None):
+        """Call warmup() of all the shards concurrently, and return the number
+        of the objects created successfully.
+
+        num and workers are split among the shards.
+        """
+
+        shards = self._shards
+        nums = [None] * len(shards)
+        if num is not None:
+            nums = [num // len(shards) + (1 if i < num % len(shards) else 0)
+                    for i in range(len(shards))]
+        if workers is not None:
+            workers = max(workers // len(shards), 1)
+
+        pool = ThreadPool(len(shards))
+        try:
+            return sum(pool.map(lambda i: shards[i].warmup(nums[i], workers),
+                                range(len(shards))))
+        finally:
+            pool.close()
+            pool.join()
+
+    def get(self, timeout=None):
+        """Get an object from the pool.
+
+        When the pool is closed, it will raise a RuntimeError if calling this
+        method.
+
+        If the capacity is limited and no object is available in timeout
+        seconds, it will raise queue.Empty.
+        """
 
-        _get = lambda obj: _ResourcePoolSession(self, obj, self._close_on_exc) \
-            if obj and self._autowrap else obj
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        start = _now()
+        index = self._get_shard_index()
+        shard = self._shards[index]
+        obj = shard._get(None, create=False, start=start)
+        if obj is _EMPTY:
+            obj, shard = self._get_slowly(index, timeout, start)
+
+        self._inherited.discard(id(obj))
+        self._owners[id(obj)] = shard
+        if self._session_cls:
+            return self._session_cls(self, obj, self._close_on_exc)
+        return obj
+
+    def _get_slowly(self, index, timeout, start):
+        shards = self._shards[index:] + self._shards[:index]
+        deadline = None if timeout is None else time.time() + timeout
+
+        obj, shard = self._steal(shards, start)
+        if obj is _EMPTY:
+            with self._lock:
+                self._waits += 1
+
+        while obj is _EMPTY:
+            # Wait for the object from the own shard, and steal it from
+            # the other shards again at intervals.
+            interval = self.STEAL_INTERVAL
+            if deadline is not None:
+                interval = min(deadline - time.time(), interval)
+                if interval <= 0:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise Empty
 
-        if not self._capacity:
             try:
-                obj = self._pools.get_nowait()
-                self._pools.task_done()
+                obj = shards[0]._get(time.time() + interval, start=start,
+                                     probe=True)
+                shard = shards[0]
             except Empty:
-                obj = (self._cls(**self._kwargs), self._get_now())
-        else:
-            obj = self._pools.get(timeout=timeout)
-            self._pools.task_done()
+                obj, shard = self._steal(shards, start)
+        return obj, shard
+
+    def _steal(self, shards, start):
+        # Fill the own shard at first, so that the thread does not keep
+        # stealing from the other shards.
+        try:
+            return shards[0]._get(time.time(), start=start, probe=True), shards[0]
+        except Empty:
+            pass
+
+        for shard in shards[1:]:
+            obj = shard._get(None, create=False, start=start)
+            if obj is not _EMPTY:
+                return obj, shard
+
+        now = time.time()
+        for shard in shards[1:]:
+            try:
+                return shard._get(now, start=start, probe=True), shard
+            except Empty:
+                pass
+
+        return _EMPTY, None
 
-        if obj and obj[0]:
-            if self._timeout and self._get_now() - obj[1] > self._timeout:
-                return _get(self.get(timeout=timeout))
-            return _get(obj[0])
+    def _get_owner(self, obj):
+        """Return the shard of the object, or None if it was borrowed before
+        forking, which belongs to the parent process."""
 
-        return _get(self._cls(**self._kwargs))
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        shard = self._owners.pop(id(obj), None)
+        if shard is None:
+            if id(obj) in self._inherited:
+                self._inherited.discard(id(obj))
+                return None
+            shard = self._shards[self._get_shard_index()]
+        return shard
 
     def put(self, obj):
         """Put an object into the pool.
 
         When the pool is closed, it will close the object, not put it into the
-        pool, if calling this method.
+        pool, if calling this method. None is ignored.
         """
 
-        with self._lock:
+        if obj is None:
+            return
+        elif isinstance(obj, _ResourcePoolSession):
+            obj.release_to_pool()
+        else:
+            self._put_from_session(obj)
+
+    def put_with_close(self, obj):
+        if obj is None:
+            return
+        elif isinstance(obj, _ResourcePoolSession):
+            obj.close()
+        else:
+            self._put_from_session(obj, close=True)
+
+    def _put_from_session(self, obj, close=False):
+        shard = self._get_owner(obj)
+        if shard is None:
+            return
+        elif close:
+            shard._discard(obj)
+        else:
+            shard._release(obj)
+
+
+class _KeyedSubPool(ResourcePool):
+    def __init__(self, keyed, factory, key, **kwargs):
+        self._keyed = keyed
+        self._last_used = _now()
+        super(_KeyedSubPool, self).__init__(functools.partial(factory, key),
+                                            **kwargs)
+
+    def _create(self, deadline=None, prefill=False):
+        self._keyed._reserve(self, deadline, prefill)
+        try:
+            return super(_KeyedSubPool, self)._create(deadline, prefill)
+        except Exception:
+            self._keyed._unreserve(1)
+            raise
+
+    def _on_destroy(self, num):
+        self._keyed._unreserve(num)
+
+    def _close_if_unused(self, before):
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            if self._size > len(self._idle) or self._last_used > before:
+                return False
+            idle = self._shutdown()
+
+        self._close_idle(idle)
+        return idle is not None
+
+
+class KeyedResourcePool(object):
+    STEAL_INTERVAL = 0.005
+
+    def __init__(self, factory, capacity_per_key=0, capacity=0,
+                 key_idle_timeout=None, autowrap=False, close_on_exc=False,
+                 reap_interval=None, **kwargs):
+        """Create a new pool object, which manages a sub-pool for each key,
+        such as the connection pool for each upstream host.
+
+        The sub-pool is created lazily when the key is used at first.
+
+        @param factory(callable): The function to create the object, which is
+                                  called with the key as the first argument,
+                                  and the other key arguments of kwargs.
+        @param capacity_per_key(int): The maximum capacity of each sub-pool.
+                                      If 0, the capacity is infinite.
+        @param capacity(int): The maximum capacity of all the sub-pools.
+                              If 0, the capacity is infinite. If reached,
+                              the idle object of other keys will be closed
+                              to make room for the new one.
+        @param key_idle_timeout(int): If no object of the key has been used
+                                      for key_idle_timeout seconds, the
+                                      sub-pool of the key will be closed and
+                                      removed by reap().
+        @param reap_interval(int): If given, start a background daemon thread
+                                   to call reap() every reap_interval seconds.
+
+        autowrap and close_on_exc are the same as ResourcePool, and the other
+        arguments of kwargs are passed to the sub-pool, ResourcePool,
+        such as idle_timeout, min_idle, max_idle, validate, etc.
+
+        Example:
+        >>> pool = KeyedResourcePool(Connection, capacity_per_key=8,
+        ...                          capacity=256, key_idle_timeout=300)
+        >>> conn = pool.get(("127.0.0.1", 8080))
+        >>> pool.put(conn)
+        """
+
+        self._factory = factory
+        self._kwargs = kwargs
+        self._capacity_per_key = capacity_per_key
+        self._key_idle_timeout = key_idle_timeout
+
+        self._closed = False
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._capacity = capacity if capacity >= 0 else 0
+        self._session_cls = _get_session_class(autowrap)
+        self._close_on_exc = close_on_exc
+
+        self._total = 0      # The number of all the objects of all the keys.
+        self._pools = {}     # key -> sub-pool
+        self._owners = {}    # The sub-pools of the borrowed objects, id(obj) -> sub-pool
+        self._inherited = set()  # The ids of the objects borrowed before forking.
+
+        self._pid = _current_pid[0]
+        self._reap_interval = reap_interval
+        self._reaper_stopped = _start_reaper(self, reap_interval)
+
+    def __del__(self):
+        if hasattr(self, "_reaper_stopped"):  # __init__ may have failed.
+            self.close()
+
+    def __len__(self):
+        return len(self._pools)
+
+    def _after_fork(self):
+        # The ids of the objects in the child process may be reused by others.
+        self._inherited.update(self._owners)
+        self._owners = {}
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._total = 0
+        if not self._closed:
+            self._reaper_stopped = _start_reaper(self, self._reap_interval)
+
+    def _get_pool(self, key):
+        pool = self._pools.get(key, None)
+        if pool is None:
+            if self._pid != _current_pid[0]:
+                _reset_after_fork(self)
+
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("The pool has been closed.")
+
+                pool = self._pools.get(key, None)
+                if pool is None:
+                    pool = self._pools[key] = _KeyedSubPool(
+                        self, self._factory, key,
+                        capacity=self._capacity_per_key, **self._kwargs)
+        return pool
+
+    def _reserve(self, pool, deadline, prefill):
+        """Reserve the place of a new object for pool.
+
+        If the capacity has been reached, close the idle object of the other
+        sub-pools, or wait until deadline. But not wait if prefill is True.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("The pool has been closed.")
+                if not self._capacity or self._total < self._capacity:
+                    self._total += 1
+                    return
+                pools = list(self._pools.values())
+
+            if prefill:
+                raise Empty
+            elif self._steal(pool, pools):
+                continue
+
+            with self._cond:
+                if self._total < self._capacity:
+                    continue
+
+                remaining = self.STEAL_INTERVAL
+                if deadline is not None:
+                    remaining = min(deadline - time.time(), remaining)
+                    if remaining <= 0:
+                        raise Empty
+                self._cond.wait(remaining)
+
+    def _unreserve(self, num):
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            self._total -= num
+            self._cond.notify(num)
+
+    def _steal(self, pool, pools):
+        """Close an idle object of the other sub-pools to release its place."""
+
+        for other in pools:
+            if other is pool:
+                continue
+
+            try:
+                obj = other._get(None, create=False, probe=True)
+            except RuntimeError:  # The sub-pool has been closed.
+                continue
+
+            if obj is not _EMPTY:
+                other._discard(obj)
+                return True
+        return False
+
+    def close(self):
+        """Close all the sub-pools and release all the objects."""
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
             if self._closed:
-                self._close_obj(obj)
                 return
+            self._closed = True
+            self._reaper_stopped.set()
+            pools, self._pools = self._pools, {}
+            self._cond.notify_all()
+
+        for pool in pools.values():
+            pool.close()
+
+    def reap(self):
+        """Call reap() of all the sub-pools, then close and remove the sub-pools
+        of the keys which have not been used for key_idle_timeout seconds.
+        """
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            if self._closed:
+                return
+            pools = list(self._pools.items())
+
+        before = _now() - (self._key_idle_timeout or 0)
+        for key, pool in pools:
+            if self._key_idle_timeout and pool._close_if_unused(before):
+                with self._cond:
+                    if self._pools.get(key, None) is pool:
+                        self._pools.pop(key)
+            else:
+                pool.reap()
+
+    def stats(self, key=None):
+        """Return the statistics of the sub-pool of the key, or the sum of
+        all the sub-pools if key is None.
+
+        See ResourcePool.stats().
+        """
+
+        if key is not None:
+            pool = self._pools.get(key, None)
+            return pool.stats() if pool else None
+
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
+
+        with self._cond:
+            pools = list(self._pools.values())
+        stats = _merge_stats(pool.stats() for pool in pools)
+        stats["keys"] = len(pools)
+        return stats
+
+    def get(self, key, timeout=None):
+        """Get an object of the key from the pool.
+
+        When the pool is closed, it will raise a RuntimeError if calling this
+        method.
+
+        If the capacity is limited and no object is available in timeout
+        seconds, it will raise queue.Empty.
+        """
+
+        start = _now()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            pool = self._get_pool(key)
+            pool._last_used = start
+            try:
+                obj = pool._get(deadline, start=start)
+                break
+            except RuntimeError:
+                # The sub-pool has been closed and removed by reap(),
+                # so try it again with the new sub-pool.
+                if self._closed or not pool._closed:
+                    raise
+
+        self._inherited.discard(id(obj))
+        self._owners[id(obj)] = pool
+        if self._session_cls:
+            return self._session_cls(self, obj, self._close_on_exc)
+        return obj
+
+    def put(self, obj):
+        """Put an object into the pool.
+
+        When the pool is closed, it will close the object, not put it into the
+        pool, if calling this method.
+        """
 
         if isinstance(obj, _ResourcePoolSession):
             obj.release_to_pool()
         else:
-            self._pools.put_nowait((obj, self._get_now()))
+            self._put_from_session(obj)
 
     def put_with_close(self, obj):
-        self._close_obj(obj)
-        self.put(None)
+        if isinstance(obj, _ResourcePoolSession):
+            obj.close()
+        else:
+            self._put_from_session(obj, close=True)
+
+    def _put_from_session(self, obj, close=False):
+        if self._pid != _current_pid[0]:
+            _reset_after_fork(self)
 
-    def _put_from_session(self, obj):
-        self._pools.put_nowait((obj, self._get_now()))
+        pool = self._owners.pop(id(obj), None)
+        if pool is None:
+            if id(obj) in self._inherited:
+                # Borrowed before forking, which belongs to the parent process.
+                self._inherited.discard(id(obj))
+                return
+            raise ValueError("The object does not belong to the pool")
+        elif close:
+            pool._discard(obj)
+        else:
+            pool._release(obj)
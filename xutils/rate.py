@@ -1,52 +1,459 @@
 # -*- coding: utf-8 -*-
+"""The rate limiters.
+
+The algorithms, TokenBucket, GCRA, SlidingWindowCounter and SlidingWindowLog,
+share one interface, and may be selected by the argument algorithm of Rate:
+
+    algorithm(rate, burst)      create the limiter
+    limiter.rate                the number of the tokens per second
+    limiter.burst               the maximum number of the tokens at once
+    limiter.try_acquire(n, now) return 0.0 if acquired, or the delay until
+                                the n tokens are available
+
+They are not thread-safe, and Rate locks them.
+"""
 
 from __future__ import division
 
 import time
+import struct
+
+from collections import deque
+from threading import Lock
 
-from threading import Thread
 try:
-    from queue import Queue
+    from time import monotonic
 except ImportError:
-    from Queue import Queue
+    monotonic = time.time
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """The token bucket, which is refilled lazily by the elapsed time
+        when acquiring the tokens, so it needs no thread or timer.
+
+        @param rate(float): The number of the tokens refilled per second.
+        @param burst(int): The capacity of the bucket, that's, the maximum
+                           number of the tokens acquired at once.
+                           The default is rate, at least 1.
+
+        It's not thread-safe, and the caller should lock it if need.
+        The bucket is full at first.
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self._tokens = float(self.burst)
+        self._last = None
+
+    def try_acquire(self, n=1, now=None):
+        """Try to acquire n tokens at now, which is the time by the monotonic
+        clock. If None, use the current time.
+
+        Return 0.0 if acquired, or the delay in seconds until the n tokens
+        are available, in which case nothing is acquired.
+        """
+
+        if now is None:
+            now = monotonic()
+
+        tokens = self._tokens
+        if self._last is not None and now > self._last:
+            tokens = min(self.burst, tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        if tokens >= n - 1e-9:  # Ignore the rounding error of the float time.
+            self._tokens = max(tokens - n, 0.0)
+            return 0.0
+
+        self._tokens = tokens
+        return (n - tokens) / self.rate
+
+
+class GCRA(object):
+    def __init__(self, rate, burst=None):
+        """The Generic Cell Rate Algorithm, which is equivalent to the token
+        bucket, but only has one float as the state, the theoretical arrival
+        time of the next token.
+
+        The arguments are the same as TokenBucket.
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self._interval = 1.0 / rate
+        self._tolerance = self.burst * self._interval
+        self._tat = 0.0
+
+    def try_acquire(self, n=1, now=None):
+        """The same as TokenBucket.try_acquire()."""
+
+        if now is None:
+            now = monotonic()
+
+        tat = max(self._tat, now) + n * self._interval
+        delay = tat - now - self._tolerance
+        if delay > 1e-9:  # Ignore the rounding error of the float time.
+            return delay
+
+        self._tat = tat
+        return 0.0
+
+
+class SlidingWindowCounter(object):
+    def __init__(self, rate, burst=None):
+        """The sliding window counter, which allows at most burst tokens in any
+        window of burst / rate seconds, such as rate tokens per second by
+        default, approximately.
+
+        The arguments are the same as TokenBucket.
+
+        It only counts the tokens in the current and previous fixed windows,
+        and weights the previous one by its overlap with the sliding window.
+        So it under-delivers by up to one token per window, that's, 1 / burst
+        of the rate, such as 10% with the burst 10.
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self._window = self.burst / self.rate
+        self._start = None  # The start time of the current fixed window
+        self._prev = 0
+        self._curr = 0
+
+    def _roll(self, now):
+        if self._start is None:
+            self._start = now - now % self._window
+            return
+
+        windows = int((now - self._start) // self._window)
+        if windows > 0:
+            self._prev = self._curr if windows == 1 else 0
+            self._curr = 0
+            self._start += windows * self._window
+
+    def try_acquire(self, n=1, now=None):
+        """The same as TokenBucket.try_acquire()."""
+
+        if now is None:
+            now = monotonic()
+
+        self._roll(now)
+        window, burst = self._window, self.burst
+        elapsed = max(now - self._start, 0)
+        count = self._prev * (1 - elapsed / window) + self._curr
+        if count + n <= burst:
+            self._curr += n
+            return 0.0
+
+        if self._curr + n > burst:
+            # Wait for the next window, in which the current one is previous.
+            return (window - elapsed) + window * (1 - (burst - n) / max(self._curr, n))
+
+        # Wait until the weight of the previous window decreases enough.
+        delay = window * (1 - (burst - self._curr - n) / self._prev) - elapsed
+        return max(delay, 1e-6)
+
+
+class SlidingWindowLog(object):
+    def __init__(self, rate, burst=None):
+        """The sliding window log, which allows at most burst tokens in any
+        window of burst / rate seconds, such as rate tokens per second by
+        default, exactly.
+
+        The arguments are the same as TokenBucket.
+
+        It logs the time of every acquisition in the window, so its memory is
+        O(burst).
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self._window = self.burst / self.rate
+        self._log = deque()  # Each is (time, n)
+        self._total = 0
+
+    def try_acquire(self, n=1, now=None):
+        """The same as TokenBucket.try_acquire()."""
+
+        if now is None:
+            now = monotonic()
+
+        log, start = self._log, now - self._window
+        while log and log[0][0] <= start:
+            self._total -= log.popleft()[1]
+
+        if self._total + n <= self.burst:
+            log.append((now, n))
+            self._total += n
+            return 0.0
+
+        # Wait until the oldest acquisitions leave the window.
+        need, total = self._total + n - self.burst, 0
+        for acquired, k in log:
+            total += k
+            if total >= need:
+                return max(acquired - start, 1e-6)
+        return self._window
 
 
 class Rate(object):
-    def __init__(self, rate, hz=10):
+    def __init__(self, rate, hz=10, burst=None, algorithm=None):
+        """The rate limiter.
+
+        @param rate(int): The number of the tokens per second.
+        @param hz(int): It only decides the default burst now, because the
+                        tokens are refilled continuously.
+        @param burst(int): The maximum number of the tokens which may be
+                           acquired at once. The default is rate // hz,
+                           at least 1, which is the number of the tokens
+                           refilled every 1 / hz seconds before.
+        @param algorithm(class): The algorithm, such as TokenBucket, GCRA,
+                                 SlidingWindowCounter or SlidingWindowLog,
+                                 which is called with rate and burst.
+                                 The default is TokenBucket.
+                                 The window of the sliding ones is burst / rate
+                                 seconds, only 1 / hz by default, in which
+                                 SlidingWindowCounter delivers 1 / burst less
+                                 than the rate, such as 90/s for Rate(100).
+                                 Give a larger burst to reduce it.
+
+        It's thread-safe.
+        """
+
         if rate < 1 or hz < 1:
             raise ValueError("rate and hz must be a positive integer")
 
-        _rate = rate // hz
-        _rate, interval = (_rate, 1.0 / hz) if _rate else (1, 1.0 / rate)
+        self._lock = Lock()
+        burst = burst or max(int(rate // hz), 1)
+        self._bucket = (algorithm or TokenBucket)(rate, burst)
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    @property
+    def burst(self):
+        return self._bucket.burst
 
-        self._rate = _rate
-        self._interval = interval
-        self._queue = Queue(rate)
+    def _check(self, n):
+        if n < 1 or n > self._bucket.burst:
+            raise ValueError("n must be between 1 and the burst %s"
+                             % self._bucket.burst)
 
-        self._thread = Thread(target=self._start)
-        self._thread.daemon = True
-        self._thread.start()
+    def _try_acquire(self, n):
+        with self._lock:
+            return self._bucket.try_acquire(n, monotonic())
 
-    def _start(self):
+    def get_token(self, n=1, timeout=None):
+        """Acquire n tokens, and block until they are available.
+
+        If timeout is not None, wait for at most timeout seconds, and return
+        False if the tokens cannot be acquired in time, without waiting when
+        it's known beforehand. Return True if acquired.
+        """
+
+        self._check(n)
+        deadline = None if timeout is None else monotonic() + timeout
         while True:
-            diff = self._rate - self._queue.qsize()
-            while diff > 0:
-                self._queue.put(None)
-                diff -= 1
-            time.sleep(self._interval)
-
-    def get_token(self):
-        """Return a token if exists. Or it will be blocked."""
-
-        self._queue.get()
-        self._queue.task_done()
-
-    def allow(self):
-        """Return True if there is a token, or False. It never be blocked."""
-
-        try:
-            self._queue.get_nowait()
-        except Exception:
-            return False
-        else:
-            return True
+            delay = self._try_acquire(n)
+            if not delay:
+                return True
+
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if delay > remaining:
+                    return False
+            time.sleep(delay)
+
+    def allow(self, n=1):
+        """Return True if there are n tokens, or False. It never be blocked."""
+
+        self._check(n)
+        return not self._try_acquire(n)
+
+
+class SharedRate(Rate):
+    MAGIC = b"XRT1"
+
+    # magic, the theoretical arrival time of GCRA.
+    LAYOUT = struct.Struct("<4sd")
+
+    def __init__(self, path, rate, hz=10, burst=None):
+        """The rate limiter shared by all the processes on the host opening
+        the same path, such as the prefork workers of gunicorn, so that they
+        draw from one bucket.
+
+        @param path(str): The path of the file as the shared memory,
+                          such as "/dev/shm/myapp-rate-partner".
+
+        The other arguments are the same as Rate, which should be the same
+        for all the processes. The algorithm is GCRA, whose state is one float
+        by the monotonic clock, which is system-wide. It requires fcntl,
+        see xutils.shm.
+
+        Example:
+        >>> rate = SharedRate("/dev/shm/myapp-rate-partner", 100)
+        >>> rate.get_token()
+        """
+
+        from xutils.shm import SharedMemory
+
+        super(SharedRate, self).__init__(rate, hz, burst, algorithm=GCRA)
+        self._shm = SharedMemory(path, self.LAYOUT.size)
+
+    def _try_acquire(self, n):
+        # The lock of the shared memory also excludes the other threads.
+        gcra, shm = self._bucket, self._shm
+        with shm:
+            now = monotonic()
+            magic, tat = shm.unpack(self.LAYOUT)
+
+            # The state may be left by another boot, whose clock is different.
+            if magic != self.MAGIC or tat - now > gcra._tolerance:
+                tat = 0.0
+
+            gcra._tat = tat
+            delay = gcra.try_acquire(n, now)
+            if not delay:
+                shm.pack(self.LAYOUT, (self.MAGIC, gcra._tat))
+            return delay
+
+
+class KeyedRate(object):
+    MAX_KEYS = 1000000
+
+    # Sweep the idle keys when the number of the keys reaches it at least.
+    MIN_SWEEP_KEYS = 1024
+
+    # The number of the oldest keys checked by the sweep for each new key.
+    SWEEP_BATCH = 2
+
+    def __init__(self, rate, burst=None, max_keys=None):
+        """The rate limiters per key, such as the API key or the client IP,
+        which have the same rate and burst.
+
+        @param rate(float): The number of the tokens per second of each key.
+        @param burst(int): The maximum number of the tokens which may be
+                           acquired at once by each key. The default is rate.
+        @param max_keys(int): The maximum number of the keys to remember.
+
+        It's based on GCRA, which is equivalent to the token bucket, and only
+        stores one float per key, the theoretical arrival time, by which the
+        key is idle if it has passed. Since the idle key is the same as the
+        new one, it's removed lazily without any side effect: each new key
+        checks a few oldest keys in turn, and removes the idle ones. If the
+        keys reach max_keys even though, the one nearest to be idle among
+        them will be removed, which allows it to burst again.
+
+        It's thread-safe, and the cost to check a key is O(1), even for the
+        new key.
+
+        Example:
+        >>> rates = KeyedRate(10, burst=20)
+        >>> if not rates.allow(client_ip):
+        ...     return "429 Too Many Requests"
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self._interval = 1.0 / rate
+        self._burst = burst or max(int(rate), 1)
+        self._tolerance = self._burst * self._interval
+        self._max_keys = max_keys or self.MAX_KEYS
+
+        self._lock = Lock()
+        self._tats = {}
+        self._keys = deque()  # All the keys of _tats, from the oldest checked
+        self._sweep_at = min(self.MIN_SWEEP_KEYS, self._max_keys)
+
+    @property
+    def rate(self):
+        return 1.0 / self._interval
+
+    @property
+    def burst(self):
+        return self._burst
+
+    def __len__(self):
+        return len(self._tats)
+
+    def try_acquire(self, key, n=1, now=None):
+        """Try to acquire n tokens of the key at now, which is the time by
+        the monotonic clock. If None, use the current time.
+
+        Return 0.0 if acquired, or the delay in seconds until the n tokens
+        are available, in which case nothing is acquired.
+        """
+
+        if n < 1 or n > self._burst:
+            raise ValueError("n must be between 1 and the burst %s" % self._burst)
+
+        with self._lock:
+            if now is None:
+                now = monotonic()
+
+            tats = self._tats
+            tat = tats.get(key, now)
+            if tat < now:
+                tat = now
+
+            tat += n * self._interval
+            delay = tat - now - self._tolerance
+            if delay > 1e-9:  # Ignore the rounding error of the float time.
+                return delay
+
+            if key not in tats:
+                if len(tats) >= self._sweep_at:
+                    self._sweep(now)
+                self._keys.append(key)
+            tats[key] = tat
+            return 0.0
+
+    def allow(self, key, n=1):
+        """Return True if the key has n tokens, or False. It never be blocked."""
+
+        return not self.try_acquire(key, n)
+
+    def remove(self, key):
+        """Forget the key, which allows it to burst again."""
+
+        with self._lock:
+            # Only make it idle, which is the same as removing it, and leave
+            # it to the sweep, so that _keys needn't be searched.
+            if key in self._tats:
+                self._tats[key] = 0.0
+
+    def _sweep(self, now):
+        # Check a few oldest keys in turn, instead of all of them, so the
+        # cost is O(1). An idle key is found after len(keys) / SWEEP_BATCH
+        # new keys at most.
+        tats, keys = self._tats, self._keys
+        active = []
+        for _ in range(min(self.SWEEP_BATCH, len(keys))):
+            key = keys.popleft()
+            if tats[key] <= now:
+                del tats[key]
+            else:
+                active.append(key)
+
+        # All the checked keys are active if still full.
+        if active and len(tats) >= self._max_keys:
+            nearest = min(active, key=tats.__getitem__)
+            active.remove(nearest)
+            del tats[nearest]
+
+        keys.extend(active)
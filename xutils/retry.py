@@ -1,17 +1,133 @@
 # -*- coding: utf-8 -*-
 
 import time
+import random
 import functools
 
+from threading import Lock
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time.time
+
+JITTER_NONE = "none"
+JITTER_FULL = "full"
+JITTER_EQUAL = "equal"
+JITTER_DECORRELATED = "decorrelated"
+_JITTERS = (JITTER_NONE, JITTER_FULL, JITTER_EQUAL, JITTER_DECORRELATED)
+
+
+class RetryBudget(object):
+    def __init__(self, ratio=0.1, min_retries_per_sec=1, max_tokens=None):
+        """The budget of the retries, which is shared by the callers of the same
+        dependency, to cap the retries at a ratio of the recent calls.
+
+        @param ratio(float): Each call deposits ratio tokens, and each retry
+                             withdraws one token, such as 0.1 for 10% retries.
+        @param min_retries_per_sec(float): The tokens deposited per second in
+                                           addition, so that the callers with
+                                           few calls may still retry.
+        @param max_tokens(float): The maximum tokens, which bounds the burst of
+                                  the retries after a quiet period.
+                                  The default is 10 / ratio, at least 10.
+
+        The budget is empty at first, so the retries are at most ratio of the
+        calls, plus min_retries_per_sec. It's thread-safe.
+
+        Example:
+        >>> budget = RetryBudget(0.1)
+        >>> retry = Retry(jitter=JITTER_FULL, budget=budget)
+        """
+
+        if ratio < 0 or min_retries_per_sec < 0:
+            raise ValueError("ratio and min_retries_per_sec must not be negative")
+
+        self._ratio = ratio
+        self._min_retries_per_sec = min_retries_per_sec
+        self._max_tokens = max_tokens or max(10.0 / ratio if ratio else 0, 10.0)
+
+        self._lock = Lock()
+        self._tokens = 0.0
+        self._last = monotonic()
+        self._rejected = 0
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(monotonic())
+            return self._tokens
+
+    @property
+    def rejected(self):
+        """Return the number of the retries rejected by the budget."""
+
+        return self._rejected
+
+    def _refill(self, now):
+        if self._min_retries_per_sec and now > self._last:
+            self._tokens = min(self._max_tokens, self._tokens +
+                               (now - self._last) * self._min_retries_per_sec)
+        self._last = now
+
+    def deposit(self):
+        """Deposit the tokens for a call, not including the retries."""
+
+        with self._lock:
+            self._refill(monotonic())
+            self._tokens = min(self._max_tokens, self._tokens + self._ratio)
+
+    def try_withdraw(self):
+        """Withdraw a token for a retry, and return True. Or return False
+        if the budget is exhausted."""
+
+        with self._lock:
+            self._refill(monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self._rejected += 1
+            return False
+
 
 class Retry(object):
     def __init__(self, max_retries=2, retry_interval=1, max_retry_interval=5,
-                 increase_retry_interval=True, exceptions=(IOError, OSError)):
+                 increase_retry_interval=True, exceptions=(IOError, OSError),
+                 jitter=JITTER_NONE, budget=None):
+        """Retry the call when one of the exceptions is raised.
+
+        @param max_retries(int): The maximum number of the retries.
+        @param retry_interval(float): The interval before the first retry.
+        @param max_retry_interval(float): The maximum interval.
+        @param increase_retry_interval(bool): If True, double the interval
+                                              after each retry.
+        @param exceptions(tuple): The exceptions to retry.
+        @param jitter(str): The jitter of the interval, which spreads the
+                            retries of the clients so that they don't retry
+                            in lockstep.
+                            JITTER_NONE: sleep the interval.
+                            JITTER_FULL: sleep a random time in [0, interval].
+                            JITTER_EQUAL: sleep a random time in
+                                          [interval / 2, interval].
+                            JITTER_DECORRELATED: sleep a random time in
+                                [retry_interval, 3 * the last sleep], up to
+                                max_retry_interval, regardless of
+                                increase_retry_interval.
+        @param budget(RetryBudget): If not None, the retry is given up, and the
+                                    exception is raised, when the budget is
+                                    exhausted.
+        """
+
+        if jitter not in _JITTERS:
+            raise ValueError("unknown jitter '%s'" % jitter)
+
         self._max_retries = max_retries
         self._retry_interval = retry_interval
         self._max_retry_interval = max_retry_interval
         self._increase_retry_interval = increase_retry_interval
         self._exceptions = exceptions
+        self._jitter = jitter
+        self._budget = budget
 
     def __call__(self, func):
         @functools.wraps(func)
@@ -20,9 +136,22 @@ class Retry(object):
 
         return wrapper
 
+    def _get_sleep(self, interval, last_sleep):
+        jitter = self._jitter
+        if jitter == JITTER_FULL:
+            return random.uniform(0, interval)
+        elif jitter == JITTER_EQUAL:
+            return interval / 2.0 + random.uniform(0, interval / 2.0)
+        elif jitter == JITTER_DECORRELATED:
+            return min(self._max_retry_interval,
+                       random.uniform(self._retry_interval, last_sleep * 3))
+        return interval
+
     def call(self, func, *args, **kwargs):
-        interval = self._retry_interval
+        interval = last_sleep = self._retry_interval
         remaining_retries = self._max_retries
+        if self._budget:
+            self._budget.deposit()
 
         while True:
             try:
@@ -30,7 +159,10 @@ class Retry(object):
             except self._exceptions:
                 if remaining_retries <= 0:
                     raise
-                time.sleep(interval)
+                if self._budget and not self._budget.try_withdraw():
+                    raise
+                last_sleep = self._get_sleep(interval, last_sleep)
+                time.sleep(last_sleep)
                 if self._increase_retry_interval:
                     interval = min(interval * 2, self._max_retry_interval)
                 remaining_retries -= 1
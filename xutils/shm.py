@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""The shared memory based on the mmapped file, which is shared by all the
+processes on the host opening the same file, such as the prefork workers.
+
+It requires fcntl, that's, only on the POSIX platforms.
+"""
+
+import os
+import mmap
+
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SharedMemory(object):
+    def __init__(self, path, size, mode=0o600):
+        """Map the file into the shared memory, which will be created and
+        filled with zero if not exist.
+
+        @param path(str): The path of the file, such as "/dev/shm/myapp-cb".
+        @param size(int): The size of the shared memory in bytes.
+        @param mode(int): The permission of the file when created.
+
+        The memory must be accessed with the lock held, which excludes both
+        the other processes, by fcntl.flock, and the other threads. It's safe
+        to be inherited by the child process, which will open the file again
+        for its own lock.
+
+        Example:
+        >>> COUNTER = struct.Struct("<Q")
+        >>> shm = SharedMemory("/dev/shm/myapp-counter", COUNTER.size)
+        >>> with shm:
+        ...     value = shm.unpack(COUNTER)[0] + 1
+        ...     shm.pack(COUNTER, (value,))
+        """
+
+        if fcntl is None:
+            raise RuntimeError("SharedMemory requires fcntl")
+        if size < 1:
+            raise ValueError("size must be a positive integer")
+
+        self._path = path
+        self._size = size
+        self._mode = mode
+        self._lock = Lock()
+
+        self._fd = self._open()
+        try:
+            with self:
+                if os.fstat(self._fd).st_size < size:
+                    os.ftruncate(self._fd, size)
+            self._mmap = mmap.mmap(self._fd, size, mmap.MAP_SHARED,
+                                   mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return self._size
+
+    def _open(self):
+        self._pid = os.getpid()
+        return os.open(self._path, os.O_RDWR | os.O_CREAT, self._mode)
+
+    def close(self):
+        """Unmap the memory and close the file, but not remove the file."""
+
+        if self._fd is not None:
+            self._mmap.close()
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            # The child process shares the open file description of the parent,
+            # on which the lock is held, so open the file again to own the lock.
+            if self._pid != os.getpid():
+                os.close(self._fd)
+                self._fd = self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def unpack(self, struct, offset=0):
+        """Read the values of the struct.Struct at offset.
+
+        The lock must be held.
+        """
+
+        return struct.unpack_from(self._mmap, offset)
+
+    def pack(self, struct, values, offset=0):
+        """Write the values of the struct.Struct at offset.
+
+        The lock must be held.
+        """
+
+        struct.pack_into(self._mmap, offset, *values)
@@ -3,6 +3,7 @@
 
 import sys
 import json
+import math
 import time
 import logging
 import traceback
@@ -10,6 +11,7 @@ import traceback
 import falcon
 import xutils
 
+from xutils.rate import KeyedRate
 from xutils.util import json_loads
 from wsgiref.simple_server import WSGIRequestHandler, WSGIServer as _WSGIServer
 try:
@@ -107,6 +109,51 @@ class LogMiddleware(object):
                      req._endtime - req._starttime)
 
 
+class RateLimitMiddleware(object):
+    def __init__(self, rate=None, burst=None, key_func=None, limiter=None,
+                 max_keys=None):
+        """Limit the rate of the requests per key before routing, such as per
+        client IP, and respond 429 with Retry-After when the limit is reached.
+
+        @param rate(float): The number of the requests per second of each key.
+        @param burst(int): The maximum number of the requests at once of each
+                           key. The default is rate.
+        @param key_func(callable): The function taking the request and returning
+                                   the key. If it returns None, the request is
+                                   not limited. The default is the client IP,
+                                   that's, req.remote_addr.
+        @param limiter(KeyedRate): The limiter per key. If given, rate, burst
+                                   and max_keys are ignored.
+        @param max_keys(int): The maximum number of the keys to remember.
+
+        Example:
+        >>> limit = RateLimitMiddleware(10, burst=20,
+        ...                             key_func=lambda req: req.get_header("X-API-Key"))
+        >>> app = falcon.API(middleware=[limit])
+        """
+
+        if limiter is None:
+            if not rate:
+                raise ValueError("rate or limiter is required")
+            limiter = KeyedRate(rate, burst, max_keys)
+
+        self._limiter = limiter
+        self._key_func = key_func or (lambda req: req.remote_addr)
+
+    def process_request(self, req, resp):
+        key = self._key_func(req)
+        if key is None:
+            return
+
+        delay = self._limiter.try_acquire(key)
+        if delay:
+            # Retry-After must be an integer, so round it up not to retry early.
+            raise falcon.HTTPTooManyRequests(
+                title="Too Many Requests",
+                description="The rate limit is exceeded.",
+                retry_after=int(math.ceil(delay)))
+
+
 class Router(falcon.routing.DefaultRouter):
     def _get_action(self, resource, action):
         return action if callable(action) else getattr(resource, action)